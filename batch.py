@@ -0,0 +1,253 @@
+"""
+Pre-render variants of many originals, outside of the HTTP server.
+
+Variants are written to the same sharded layout and filenames `/transform` uses,
+so the server serves them as cache hits once it (re)loads its disk cache index.
+
+Usage:
+    python batch.py 'tmf-original/*.jpg' img2/ --manifest variants.txt --format webp --format original
+
+The manifest has one query string per line, ex.
+
+    # homepage cards
+    width=300
+    width=600&fit=cover&height=400
+"""
+import argparse
+from concurrent.futures import as_completed
+from dataclasses import dataclass
+from glob import glob
+import os
+import time
+from typing import List, Tuple
+
+from pydantic import ValidationError
+
+from cache import DiskCache
+from config import EncodeProfileEnum, ImageOptions
+from engine import TransformEngine, render_variant
+from naming import get_extension, get_query_param_dict, get_variant_name, str2bool
+from utils import write_file_atomic
+
+
+LOCAL_TRANSFORMED_IMG_DIRECTORY = 'tmf-transformed'
+FORMAT_ACCEPT_HEADERS = {
+    'webp': 'image/webp',
+    'original': None,
+}
+
+
+class ManifestError(Exception):
+    """
+    Raised when a manifest line isn't a valid set of transform options.
+    """
+
+
+@dataclass(frozen=True)
+class Variant:
+    options: ImageOptions
+    transformed_img_name: str
+    output_file: str
+
+
+def load_manifest(manifest_file: str) -> List[dict]:
+    """
+    Read query param dicts from a manifest, skipping blank lines and comments.
+
+    Every line is checked up front, so an invalid one is reported
+    with its line number before anything is rendered.
+    """
+    manifest = []
+
+    with open(manifest_file) as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+
+            if not line or line.startswith('#'):
+                continue
+
+            query_params = get_query_param_dict(line.lstrip('?'))
+
+            try:
+                ImageOptions(**query_params)
+            except ValidationError as e:
+                errors = ', '.join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+                raise ManifestError(f'{manifest_file}:{line_number}: invalid variant {line!r} ({errors})') from None
+
+            manifest.append(query_params)
+
+    return manifest
+
+
+def find_originals(sources: List[str]) -> List[str]:
+    """
+    Expand directories and globs into a sorted list of image paths.
+    """
+    originals = set()
+
+    for source in sources:
+        if os.path.isdir(source):
+            source = os.path.join(source, '*')
+
+        originals.update(path for path in glob(source) if os.path.isfile(path))
+
+    return sorted(originals)
+
+
+def is_up_to_date(output_file: str, img_name: str) -> bool:
+    """
+    A variant is up to date if it exists and is newer than its original.
+    """
+    try:
+        return os.path.getmtime(output_file) >= os.path.getmtime(img_name)
+    except FileNotFoundError:
+        return False
+
+
+def plan_variants(img_name: str, manifest: List[dict], formats: List[str], disk_cache: DiskCache) -> List[Variant]:
+    """
+    Build the variants of one original, named the same way as `/transform`.
+
+    Manifest lines that name the same variant, ex. `width=300` and `w=300`,
+    are only rendered once.
+    """
+    variants = {}
+    stat = os.stat(img_name)
+
+    for query_params in manifest:
+        options = ImageOptions(**query_params)
+
+        extensions = dict.fromkeys(
+            get_extension(
+                accept_header=FORMAT_ACCEPT_HEADERS[image_format],
+                image_filename=img_name,
+                enable_webp=str2bool(query_params.get('enable_webp', 'true'))
+            )
+            for image_format in formats
+        )
+
+        for extension in extensions:
+            transformed_img_name = get_variant_name(img_name, options, extension, stat)
+            variants.setdefault(transformed_img_name, Variant(
+                options=options,
+                transformed_img_name=transformed_img_name,
+                output_file=disk_cache.path_for(transformed_img_name)
+            ))
+
+    return list(variants.values())
+
+
+def render_variants(img_name: str, variants: List[Variant], encode_profile: EncodeProfileEnum) -> Tuple[int, int]:
+    """
+    Render and write every variant of one original, in a worker process.
+
+    All variants of an original go to the same worker,
+    so the original is only decoded once. Variants are encoded with
+    `encode_profile` unless their manifest line picks a profile.
+
+    Returns the number of variants and bytes written.
+    """
+    written = 0
+
+    for variant in variants:
+        content, _, _ = render_variant(
+            img_name, variant.options, variant.transformed_img_name, encode_profile=encode_profile
+        )
+        os.makedirs(os.path.dirname(variant.output_file), exist_ok=True)
+        write_file_atomic(variant.output_file, content)
+        written += len(content)
+
+    return len(variants), written
+
+
+def run(args: argparse.Namespace) -> int:
+    manifest = load_manifest(args.manifest)
+    originals = find_originals(args.originals)
+    disk_cache = DiskCache(directory=args.output, max_bytes=0)
+
+    jobs = {}
+    skipped = 0
+
+    for img_name in originals:
+        variants = plan_variants(img_name, manifest, args.format, disk_cache)
+        pending = [v for v in variants if args.force or not is_up_to_date(v.output_file, img_name)]
+        skipped += len(variants) - len(pending)
+
+        if pending:
+            jobs[img_name] = pending
+
+    total = sum(len(variants) for variants in jobs.values())
+    print(f'{len(originals)} originals, {total} variants to render, {skipped} up to date')
+
+    engine = TransformEngine(max_workers=args.workers)
+    rendered = failed = written = 0
+    start = time.perf_counter()
+
+    try:
+        futures = {
+            engine.executor.submit(render_variants, img_name, variants, EncodeProfileEnum(args.profile)): img_name
+            for img_name, variants in jobs.items()
+        }
+
+        for done, future in enumerate(as_completed(futures), start=1):
+            img_name = futures[future]
+
+            try:
+                count, size = future.result()
+            except Exception as e:
+                failed += len(jobs[img_name])
+                print(f'❌ {img_name}: {e!r}')
+            else:
+                rendered += count
+                written += size
+
+            elapsed = time.perf_counter() - start
+            print(
+                f'[{done}/{len(jobs)}] {img_name} '
+                f'{rendered} variants, {rendered / elapsed:.1f} variants/s, {written / elapsed / 1024 / 1024:.1f} MiB/s'
+            )
+    finally:
+        engine.shutdown()
+
+    elapsed = time.perf_counter() - start
+    print(f'Rendered {rendered} variants ({written / 1024 / 1024:.1f} MiB) in {elapsed:.1f}s, {failed} failed')
+
+    return 1 if failed else 0
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Pre-render image variants from a manifest of query strings.')
+    parser.add_argument('originals', nargs='+', help='Directories or globs of original images')
+    parser.add_argument('--manifest', required=True, help='File with one variant query string per line')
+    parser.add_argument(
+        '--format',
+        action='append',
+        choices=list(FORMAT_ACCEPT_HEADERS),
+        help='Output formats to render, can be repeated (default: webp and original)'
+    )
+    parser.add_argument(
+        '--profile',
+        choices=[profile.value for profile in EncodeProfileEnum],
+        default=EncodeProfileEnum.MAX.value,
+        help='Encoder profile, trading encode time for smaller files (default: max)'
+    )
+    parser.add_argument('--output', default=LOCAL_TRANSFORMED_IMG_DIRECTORY, help='Transformed image directory')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes')
+    parser.add_argument('--force', action='store_true', help='Render variants even if they are up to date')
+
+    return parser
+
+
+def main() -> int:
+    parser = get_parser()
+    args = parser.parse_args()
+    args.format = args.format or list(FORMAT_ACCEPT_HEADERS)
+
+    try:
+        return run(args)
+    except ManifestError as e:
+        parser.error(str(e))
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,196 @@
+"""
+Benchmark `ImageTransformer.process_transform_image` over the sample images.
+
+Every image in `img/`, `img2/` and `compression/` is transformed with each option
+set in the matrix and each output format. For every case the median wall time
+per stage, the peak memory and the output size are written to a JSON file,
+which can be compared against a previous run to flag regressions.
+
+Usage:
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from glob import glob
+import json
+import platform
+import resource
+import statistics
+import sys
+import time
+from typing import List, Optional
+
+import PIL
+from PIL import Image
+
+from config import ImageOptions, ImageTransformer
+from naming import get_query_param_dict
+
+
+IMAGE_GLOBS = ['img/*', 'img2/*', 'compression/*']
+
+OPTIONS_MATRIX = [
+    'width=300',
+    'width=800',
+    'width=500&height=500&fit=contain',
+    'width=500&height=500&fit=cover',
+    'width=500&height=500&fit=crop',
+    'width=500&height=500&fit=pad&background=black',
+    'width=500&blur=5',
+    'width=500&brightness=1.5&contrast=1.3',
+    'width=500&sharpen=3',
+    'width=500&rotate=90',
+]
+
+# "original" keeps the original image's extension.
+FORMATS = ['original', '.webp', '.jpg', '.png']
+
+STAGES = ['open', 'decode', 'resize', 'effects', 'encode']
+
+
+def get_output_extension(img_name: str, output_format: str) -> str:
+    if output_format == 'original':
+        return '.' + img_name.rsplit('.', 1)[-1]
+
+    return output_format
+
+
+def run_case(img_name: str, query: str, output_format: str, repeat: int) -> dict:
+    """
+    Transform one image `repeat` times, in a fresh worker process,
+    so the peak RSS increase belongs to this case alone.
+    """
+    options = ImageOptions(**get_query_param_dict(query))
+    extension = get_output_extension(img_name, output_format)
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    runs = []
+    output_bytes = 0
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        img = Image.open(img_name)
+        open_time = time.perf_counter() - start
+
+        transformer = ImageTransformer(config=options, img=img, transformed_filename=f'benchmark{extension}')
+        buffer = transformer.process_transform_image()
+        output_bytes = buffer.getbuffer().nbytes
+
+        runs.append({'open': open_time, **transformer.timings, 'total': time.perf_counter() - start})
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return {
+        'image': img_name,
+        'options': query,
+        'format': extension,
+        'stages': {
+            stage: statistics.median(run.get(stage, 0) for run in runs)
+            for stage in STAGES
+        },
+        'total': statistics.median(run['total'] for run in runs),
+        'peak_memory_kb': peak_rss - baseline_rss,  # ru_maxrss is in KiB on Linux
+        'output_bytes': output_bytes,
+    }
+
+
+def get_case_id(img_name: str, query: str, output_format: str) -> str:
+    return f'{img_name}?{query} -> {output_format}'
+
+
+def run_benchmarks(images: List[str], matrix: List[str], formats: List[str], repeat: int) -> dict:
+    results = {}
+
+    # One process per case, run one at a time so cases don't compete for CPU.
+    with ProcessPoolExecutor(max_workers=1, max_tasks_per_child=1) as executor:
+        for img_name in images:
+            for query in matrix:
+                for output_format in formats:
+                    case_id = get_case_id(img_name, query, output_format)
+
+                    try:
+                        result = executor.submit(run_case, img_name, query, output_format, repeat).result()
+                    except Exception as e:
+                        print(f'❌ {case_id}: {e!r}')
+                        continue
+
+                    results[case_id] = result
+                    stages = ' '.join(f'{stage}={result["stages"][stage] * 1000:.1f}ms' for stage in STAGES)
+                    print(f'{case_id}: {result["total"] * 1000:.1f}ms ({stages}) {result["output_bytes"]}B')
+
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> List[str]:
+    """
+    Return a description of every case that got slower, bigger
+    or used more memory than the baseline by more than `threshold`.
+    """
+    regressions = []
+
+    for case_id, result in results.items():
+        if (before := baseline.get(case_id)) is None:
+            continue
+
+        for metric in ['total', 'peak_memory_kb', 'output_bytes']:
+            old, new = before[metric], result[metric]
+
+            if old and (new - old) / old > threshold:
+                regressions.append(f'{case_id}: {metric} {old} -> {new} (+{(new - old) / old:.0%})')
+
+    return regressions
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Benchmark image transforms over the sample images.')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file to write results to')
+    parser.add_argument('--compare', help='Previous results JSON file to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative increase flagged as a regression')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per case, the median is reported')
+    parser.add_argument('--images', nargs='+', default=IMAGE_GLOBS, help='Globs of images to benchmark')
+    parser.add_argument('--options', nargs='+', default=OPTIONS_MATRIX, help='Query strings to benchmark')
+    parser.add_argument('--formats', nargs='+', default=FORMATS, help='Output formats to benchmark')
+
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = get_parser().parse_args(argv)
+    images = sorted(path for pattern in args.images for path in glob(pattern))
+
+    results = run_benchmarks(images, args.options, args.formats, args.repeat)
+
+    report = {
+        'meta': {
+            'created': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4)
+
+    print(f'Wrote {len(results)} results to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+        if regressions := compare(results, baseline, args.threshold):
+            print(f'{len(regressions)} regressions compared to {args.compare}:')
+            print('\n'.join(regressions))
+            return 1
+
+        print(f'No regressions compared to {args.compare}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,520 @@
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import partial
+import hashlib
+import os
+import threading
+import time
+from typing import Callable, Optional, Tuple
+
+from PIL import GifImagePlugin, Image
+
+from utils import write_file_atomic
+
+
+@dataclass
+class VariantCache:
+    """
+    In-memory LRU cache of encoded image variants.
+
+    Keyed by the transformed image filename (see `naming.get_variant_name`),
+    holds at most `max_bytes` of encoded image bytes.
+    """
+    max_bytes: int
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    current_bytes: int = 0
+
+    _entries: OrderedDict = field(default_factory=OrderedDict, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Return the cached bytes for a variant and mark it as most recently used.
+        """
+        with self._lock:
+            content = self._entries.get(key)
+
+            if content is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return content
+
+    def set(self, key: str, content: bytes) -> None:
+        """
+        Store the bytes for a variant, evicting least recently used
+        variants until the cache fits within `max_bytes`.
+
+        Variants larger than the whole budget are not cached.
+        """
+        size = len(content)
+
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if (previous := self._entries.pop(key, None)) is not None:
+                self.current_bytes -= len(previous)
+
+            self._entries[key] = content
+            self.current_bytes += size
+
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= len(evicted)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+@dataclass
+class DecodedImageCache:
+    """
+    In-memory LRU cache of decoded original images.
+
+    Keyed by path and modification time, so a replaced original is decoded again,
+    by the GIF loading strategy, which decides the mode GIFs decode to, and by
+    the decoded size, so JPEGs drafted for a large downscale are kept apart from
+    full decodes. Holds at most `max_bytes` of pixel data. Callers always get
+    a copy, so transforms never modify the cached image.
+
+    Animated images are not cached, they're returned lazily opened as usual.
+    """
+    max_bytes: int
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    current_bytes: int = 0
+
+    _entries: OrderedDict = field(default_factory=OrderedDict, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @staticmethod
+    def get_pixel_bytes(img: Image.Image) -> int:
+        return img.width * img.height * len(img.getbands())
+
+    @staticmethod
+    def copy(img: Image.Image) -> Image.Image:
+        # Keep the format, so transforms treat the copy like the file it was decoded from.
+        copy = img.copy()
+        copy.format = img.format
+        return copy
+
+    def load(self, img: Image.Image) -> Tuple[Image.Image, float]:
+        """
+        Return a decoded copy of the lazily opened `img`, decoding it only on a miss,
+        and the seconds spent decoding it (0 on a hit).
+
+        A JPEG set to a reduced size with `draft` is decoded and cached at that size.
+        """
+        if getattr(img, 'is_animated', False):
+            return img, 0.0
+
+        path = img.filename
+        key = (path, os.stat(path).st_mtime_ns, GifImagePlugin.LOADING_STRATEGY, img.size)
+
+        with self._lock:
+            cached = self._entries.get(key)
+
+            if cached is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                img.close()
+                return self.copy(cached), 0.0
+
+            self.misses += 1
+
+        start = time.perf_counter()
+        img.load()
+        decode_seconds = time.perf_counter() - start
+
+        size = self.get_pixel_bytes(img)
+
+        if size <= self.max_bytes:
+            with self._lock:
+                # Another thread may have decoded the same image meanwhile.
+                if (previous := self._entries.pop(key, None)) is not None:
+                    self.current_bytes -= self.get_pixel_bytes(previous)
+
+                self._entries[key] = img
+                self.current_bytes += size
+
+                while self.current_bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.current_bytes -= self.get_pixel_bytes(evicted)
+                    self.evictions += 1
+
+        return self.copy(img), decode_seconds
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hit_rate,
+        }
+
+
+@dataclass(frozen=True)
+class CachedVariant:
+    key: str
+    size: tuple
+    original_size: tuple
+    quality: int
+    extension: str
+    generation: int = 0  # resampling steps from the original, 0 if rendered from it
+
+
+@dataclass
+class VariantAncestry:
+    """
+    Tracks resize only variants of each original, so smaller variants can be
+    resampled from a cached larger one instead of the full original.
+
+    A variant can be used as an ancestor if it's in a lossless format or was
+    encoded with at least `min_quality`, is not enlarged past the original,
+    and is at least `min_scale` times larger than the requested dimensions.
+    With the default `min_quality`, variants at the default quality of 80
+    are not ancestors.
+
+    Only variants rendered from the original are ancestors, so a variant is
+    never more than one resample and encode away from the original.
+    """
+    min_quality: int = 90
+    min_scale: float = 2.0
+    lossless_extensions: tuple = ('.png',)
+
+    derived: int = 0
+
+    # original image name -> {variant key: CachedVariant}
+    _variants: dict = field(default_factory=dict, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, img_name: str, variant: CachedVariant) -> None:
+        with self._lock:
+            self._variants.setdefault(img_name, {})[variant.key] = variant
+
+    def is_high_quality(self, variant: CachedVariant) -> bool:
+        # Palette formats lose too much color to resample from.
+        if variant.extension == '.gif':
+            return False
+
+        return variant.extension in self.lossless_extensions or variant.quality >= self.min_quality
+
+    def find(
+        self,
+        img_name: str,
+        width: Optional[int],
+        height: Optional[int],
+        is_available: Callable[[str], bool]
+    ) -> Optional[CachedVariant]:
+        """
+        Return the smallest usable ancestor for the requested dimensions, if any.
+        """
+        with self._lock:
+            variants = list(self._variants.get(img_name, {}).values())
+
+        candidates = []
+
+        for variant in variants:
+            variant_width, variant_height = variant.size
+            orig_width, orig_height = variant.original_size
+
+            if variant.generation > 0 or not self.is_high_quality(variant):
+                continue
+            if variant_width > orig_width or variant_height > orig_height:
+                continue
+            if width and variant_width < width * self.min_scale:
+                continue
+            if height and variant_height < height * self.min_scale:
+                continue
+            if not is_available(variant.key):
+                continue
+
+            candidates.append(variant)
+
+        return min(candidates, key=lambda variant: variant.size[0] * variant.size[1], default=None)
+
+
+@dataclass
+class QualityCache:
+    """
+    Encoder qualities chosen by `quality=auto`, by variant name,
+    so a variant rendered again skips the quality search.
+
+    Variant names include the original's identity (see `naming.get_variant_name`),
+    so a replaced original is searched again. Holds at most `max_entries`,
+    evicting the least recently used.
+    """
+    max_entries: int = 100_000
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    _entries: OrderedDict = field(default_factory=OrderedDict, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[int]:
+        with self._lock:
+            quality = self._entries.get(key)
+
+            if quality is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return quality
+
+    def set(self, key: str, quality: int) -> None:
+        with self._lock:
+            self._entries[key] = quality
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+@dataclass
+class DiskCache:
+    """
+    Size capped cache of encoded image variants on disk.
+
+    Files are stored in a hashed, sharded layout so no single directory grows
+    too large, ex. "puppy_width_300.webp" -> "tmf-transformed/ea/38/puppy_width_300.webp".
+
+    The index of cached files is loaded once with `load_index`, after which lookups
+    never touch the filesystem. When the cache grows past `max_bytes`, the least
+    recently used files are deleted.
+    """
+    directory: str
+    max_bytes: int
+    shard_depth: int = 2
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    current_bytes: int = 0
+
+    # key -> (path, size), ordered from least to most recently used
+    _index: OrderedDict = field(default_factory=OrderedDict, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def path_for(self, key: str) -> str:
+        """
+        Return the sharded path a variant is written to.
+        """
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        shards = [digest[i * 2:i * 2 + 2] for i in range(self.shard_depth)]
+
+        return os.path.join(self.directory, *shards, key)
+
+    def load_index(self) -> None:
+        """
+        Walk the cache directory and index every cached file,
+        ordered by last access (or modification) time.
+
+        Files written before sharding was introduced are indexed where they are.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                # Leftovers from interrupted writes
+                if filename.startswith('.tmp-'):
+                    continue
+
+                path = os.path.join(root, filename)
+                stat = os.stat(path)
+                entries.append((max(stat.st_atime, stat.st_mtime), filename, path, stat.st_size))
+
+        with self._lock:
+            self._index.clear()
+            self.current_bytes = 0
+
+            for _, key, path, size in sorted(entries):
+                self._index[key] = (path, size)
+                self.current_bytes += size
+
+        self._evict()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Return the path of a cached variant and mark it as most recently used.
+        """
+        with self._lock:
+            entry = self._index.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._index.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: str, content) -> str:
+        """
+        Atomically write a variant to its sharded path and add it to the index.
+        """
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file_atomic(path, content)
+
+        size = len(content)
+
+        with self._lock:
+            if (previous := self._index.pop(key, None)) is not None:
+                self.current_bytes -= previous[1]
+                if previous[0] != path:
+                    self._remove_file(previous[0])
+
+            self._index[key] = (path, size)
+            self.current_bytes += size
+
+        self._evict()
+        return path
+
+    def discard(self, key: str, path: Optional[str] = None) -> None:
+        """
+        Drop a variant from the index without touching the disk,
+        ex. when its file turned out to be missing.
+
+        With `path`, the entry is only dropped if it still points there,
+        so a variant written again meanwhile is kept.
+        """
+        with self._lock:
+            entry = self._index.get(key)
+
+            if entry is None or (path is not None and entry[0] != path):
+                return
+
+            del self._index[key]
+            self.current_bytes -= entry[1]
+
+    def _evict(self) -> None:
+        """
+        Delete least recently used variants until the cache fits within `max_bytes`.
+        """
+        with self._lock:
+            while self.current_bytes > self.max_bytes and self._index:
+                _, (path, size) = self._index.popitem(last=False)
+                self.current_bytes -= size
+                self.evictions += 1
+                self._remove_file(path)
+
+    @staticmethod
+    def _remove_file(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._index),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+@dataclass
+class SingleFlight:
+    """
+    Coalesce concurrent calls that produce the same result.
+
+    The first caller for a key starts the function, any callers that arrive
+    while it is running wait for it and share its result (or exception).
+
+    Only used from the event loop, so `_calls` needs no lock.
+    """
+    coalesced: int = 0
+
+    _calls: dict = field(default_factory=dict, repr=False)  # key -> asyncio.Task
+
+    async def do_async(self, key: str, func: Callable, *args, **kwargs):
+        """
+        Await the coroutine function `func` once per key.
+
+        The call runs in its own task and every caller awaits it shielded,
+        so a cancelled caller (ex. a client that disconnected) neither
+        cancels the call nor the other callers waiting for it.
+        """
+        task = self._calls.get(key)
+
+        if task is None:
+            task = self._calls[key] = asyncio.get_running_loop().create_task(func(*args, **kwargs))
+            task.add_done_callback(partial(self._finish, key))
+        else:
+            self.coalesced += 1
+
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+        # Retrieve the exception, in case every caller was cancelled before it was raised.
+        if not task.cancelled():
+            task.exception()
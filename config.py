@@ -1,11 +1,18 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import copy
 from dataclasses import dataclass, field
 from decimal import Decimal, ROUND_HALF_UP
 from enum import Enum
 from functools import cached_property
 import io
+import logging
+import math
+import time
 
-from PIL import Image, ImageColor, ImageOps, ImageFilter, ImageEnhance, GifImagePlugin
-from typing import ClassVar, Optional, Union, Literal
+from PIL import Image, ImageColor, ImageOps, ImageFilter, ImageEnhance, ImageSequence, GifImagePlugin
+from typing import ClassVar, List, Optional, Tuple, Union, Literal
 
 from pydantic import (
     BaseModel,
@@ -21,12 +28,38 @@ from pydantic import (
 )
 from pydantic.color import Color
 
-from utils import get_filename_extension, get_filename_stem
+from utils import get_filename_extension, get_filename_stem, get_ssim, write_file_atomic
 
 
+logger = logging.getLogger(__name__)
+
 # Required in order to save gifs to webp with transparency correctly!
+# This is the default, `gif_loading_strategy` picks the strategy per transform.
 GifImagePlugin.LOADING_STRATEGY = GifImagePlugin.LoadingStrategy.RGB_ALWAYS
 
+# Output formats that can store palette (P mode) frames as they are.
+PALETTE_EXTENSIONS = ('.gif',)
+
+# Keep the decoded image at least this many times larger than the target size
+# before resampling, same default as Pillow's `Image.thumbnail`.
+REDUCING_GAP = 2.0
+
+# Modes where every band is 8 bit, so point adjustments can be done with a lookup table.
+POINT_LUT_MODES = ('L', 'LA', 'RGB', 'RGBA')
+
+# Modes `fill_background_color` composites, it leaves every other mode untouched.
+TRANSPARENT_MODES = ('RGBA', 'LA')
+
+# Save formats where `quality` is a lossy encoder setting.
+LOSSY_SAVE_FORMATS = ('JPEG', 'WEBP')
+
+# `quality=auto` searches qualities in this range with at most this many trial encodes,
+# aiming for this similarity to the image before encoding unless given a byte budget.
+AUTO_QUALITY_MIN = 30
+AUTO_QUALITY_MAX = 95
+AUTO_QUALITY_MAX_TRIALS = 6
+AUTO_QUALITY_TARGET_SSIM = 0.98
+
 
 class GravityEnum(str, Enum):
     CENTER = "center"
@@ -44,6 +77,37 @@ class FitEnum(str, Enum):
     PAD = "pad"
 
 
+class EncodeProfileEnum(str, Enum):
+    FAST = "fast"
+    BALANCED = "balanced"
+    MAX = "max"
+
+
+# Encoder settings of each profile by save format, trading encode time for bytes.
+# `balanced` is what every image was encoded with before profiles existed;
+# PNG `optimize` implies the highest zlib `compress_level`.
+ENCODE_PROFILES = {
+    EncodeProfileEnum.FAST: {
+        'WEBP': {'method': 2},
+        'JPEG': {'optimize': False},
+        'PNG': {'compress_level': 1},
+        'GIF': {'optimize': False},
+    },
+    EncodeProfileEnum.BALANCED: {
+        'WEBP': {'method': 4},
+        'JPEG': {'optimize': True},
+        'PNG': {'optimize': True},
+        'GIF': {'optimize': True},
+    },
+    EncodeProfileEnum.MAX: {
+        'WEBP': {'method': 6},
+        'JPEG': {'optimize': True, 'progressive': True},
+        'PNG': {'optimize': True},
+        'GIF': {'optimize': True},
+    },
+}
+
+
 CENTER_CROP = (0.5, 0.5)
 TOP_LEFT = (0, 0)
 BOTTOM_LEFT = (1, 0)
@@ -110,9 +174,12 @@ class ImageOptions(BaseModel):
 
     dpr: Optional[conint(ge=1, le=3)]
     metadata: Optional[bool] = False
-    quality: conint(ge=0, le=100) = Field(default=80)  # has some PNG caveat with PNG8 color palette  # should we stick with 85 - CloudFlare's defaults?
+    profile: Optional[EncodeProfileEnum]  # the server's default profile when not set
+    quality: Union[conint(ge=0, le=100), Literal['auto']] = Field(default=80)  # has some PNG caveat with PNG8 color palette  # should we stick with 85 - CloudFlare's defaults?
     rotate: Optional[conint(multiple_of=90)]
     sharpen: Optional[confloat(ge=0, le=10)]
+    target_bytes: Optional[conint(gt=0)]  # byte budget for quality=auto
+    target_ssim: Optional[confloat(gt=0, le=1)]  # similarity for quality=auto
     # trim: Optional[TrimPixels]
     trim: Optional[str] = '0,0,0,0'
 
@@ -174,16 +241,49 @@ class ImageOptions(BaseModel):
 
         return values
 
+    @property
+    def is_resize_only(self) -> bool:
+        """
+        True if the only transform is a `scale_down` or `contain` resize,
+        so the output can be resampled from any larger copy of the image.
+        """
+        if self.fit not in [FitEnum.SCALE_DOWN, FitEnum.CONTAIN]:
+            return False
+
+        # A frozen frame of an animated image can't stand in for the animation.
+        if self.anim is False:
+            return False
+
+        effects = [
+            self.background, self.blur, self.brightness, self.contrast,
+            self.metadata, self.rotate, self.sharpen, self.trim
+        ]
+        return not any(effects)
+
+    @property
+    def is_palette_safe(self) -> bool:
+        """
+        True if no transform resamples or blends colors,
+        so palette images can be transformed without expanding them to RGB.
+
+        Trims and rotations by multiples of 90 degrees only move pixels around.
+        """
+        effects = [
+            self.width, self.height, self.background, self.blur,
+            self.brightness, self.contrast, self.sharpen
+        ]
+        return not any(effects)
+
     @property
     def prepared_width(self):
-        if self.dpr:
+        if self.dpr and self.width:
             return self.width * self.dpr
 
         return self.width
 
     @property
     def prepared_height(self):
-        if self.dpr:
+        if self.dpr and self.height:
             return self.height * self.dpr
 
         return self.height
@@ -192,6 +292,56 @@ i = ImageOptions(anim='true', background='black', blur=20, rotate=180, w=90, tri
 # i = ImageOptions(w=90, dpr=2)
 
 
+@dataclass(frozen=True)
+class TransformStep:
+    """
+    One operation of a transform plan.
+
+    `name` is the `ImageTransformer` method that runs it and
+    `stage` is the timing stage it is reported under.
+    """
+    name: str
+    stage: str
+    args: dict = field(default_factory=dict)
+
+    def __str__(self):
+        args = ', '.join(f'{key}={value}' for key, value in self.args.items())
+        return f'{self.name}({args})'
+
+
+def get_gif_loading_strategy(options: ImageOptions, extension: str) -> GifImagePlugin.LoadingStrategy:
+    """
+    Pick how GIF frames are decoded for a transform.
+
+    Palette frames are only kept when the output is a GIF and the transform
+    doesn't touch colors, so the frames are written back without being
+    expanded to RGB and quantized again. Everything else gets RGB(A) frames,
+    which is what converting to webp with transparency needs.
+    """
+    if extension in PALETTE_EXTENSIONS and options.is_palette_safe:
+        return GifImagePlugin.LoadingStrategy.RGB_AFTER_DIFFERENT_PALETTE_ONLY
+
+    return GifImagePlugin.LoadingStrategy.RGB_ALWAYS
+
+
+@contextmanager
+def gif_loading_strategy(strategy: GifImagePlugin.LoadingStrategy):
+    """
+    Decode GIFs with `strategy` inside the block.
+
+    Pillow reads the strategy from a module global, both when a GIF is opened
+    and each time a frame is loaded, so the image has to be opened, transformed
+    and encoded inside the block. Only one transform runs at a time in a worker,
+    so swapping the global is safe there.
+    """
+    previous = GifImagePlugin.LOADING_STRATEGY
+    GifImagePlugin.LOADING_STRATEGY = strategy
+    try:
+        yield
+    finally:
+        GifImagePlugin.LOADING_STRATEGY = previous
+
+
 @dataclass
 class ImageTransformer:
     config: ImageOptions
@@ -201,11 +351,23 @@ class ImageTransformer:
     # Set post init
     file_extension: Optional[str] = None
     save_options: dict = field(default_factory=dict)
+    original_size: Optional[tuple] = None
+    timings: dict = field(default_factory=dict)  # stage -> seconds
+    plan: List[TransformStep] = field(default_factory=list)
+    frame_workers: int = 1  # threads transforming the frames of animated images
+    encode_profile: EncodeProfileEnum = EncodeProfileEnum.BALANCED
+    quality_search_workers: int = 1  # threads running the trial encodes of quality=auto
+    quality: Optional[int] = None  # encoder quality, a previous quality=auto result skips the search
 
     def __post_init__(self):
         """
         Set some extra stuff.
         """
+        # `Image.open` only reads the header, so this is known before decoding.
+        # It's passed in when transforming from a smaller copy of the original.
+        if self.original_size is None:
+            self.original_size = self.img.size
+
         if self.is_animated:
             self._round_duration()
         
@@ -265,18 +427,208 @@ class ImageTransformer:
         """
         Apply all transformation steps to the image.
 
-        1. If animated, check anim to determine whether to freeze first frame, otherwise don't transform animated images
-        2. resizing (fit options + trim)
-        3. filters (blur, brightness, contrast, sharpen) + rotate
+        1. compile the options into a plan of the steps that change the image
+        2. if animated, check anim to determine whether to freeze the first frame,
+           otherwise run the plan on every frame
+        3. decode at a reduced size if the target is much smaller than the original
+        4. run the plan, resizing (fit options + trim) then filters (blur, brightness, contrast, sharpen) + rotate
         """
-
-        if self.is_animated:
-            if self.should_freeze_frame:
-                self.freeze_animated_image()
+        self.plan = self.compile_plan()
+        logger.debug('Transform plan for %s: %s', self.transformed_filename, self.describe_plan())
+
+        if self.should_freeze_frame:
+            # Only the first frame is decoded, then it's transformed like a still image.
+            self.freeze_animated_image()
+        elif self.is_animated:
+            # Without a plan the frames are saved as they are, read lazily by the encoder.
+            if self.plan:
+                self.transform_animation()
             return
 
-        self.apply_resize()
-        self.apply_effects()
+        with self.timed('decode'):
+            self.reduce_on_decode()
+            self.img.load()
+
+        self.run_plan()
+
+    def run_plan(self) -> None:
+        for step in self.plan:
+            with self.timed(step.stage):
+                getattr(self, step.name)(**step.args)
+
+    def transform_animation(self) -> None:
+        """
+        Run the plan on every frame of an animated image,
+        keeping each frame's duration and the loop count.
+
+        Frames are decoded one at a time and only the transformed frames are kept,
+        so the full size animation is never held in memory. Pillow's GIF, APNG and
+        WebP encoders all take the frames as a list, so the transformed frames are
+        collected before saving.
+
+        With `frame_workers` > 1 frames are transformed on a thread pool while the
+        next ones are decoded (Pillow releases the GIL while resampling and filtering),
+        with at most two frames per worker waiting at a time.
+        """
+        source = self.img
+        frames, durations = [], []
+
+        def decoded_frames():
+            # Every frame is composited onto the full canvas when it's loaded.
+            for frame in ImageSequence.Iterator(source):
+                with self.timed('decode'):
+                    frame.load()
+                    durations.append(round(frame.info.get('duration', 0)))
+                    decoded = frame.copy()
+                yield decoded
+
+        def add_frame(transformed: tuple) -> None:
+            img, timings = transformed
+            frames.append(img)
+            for stage, seconds in timings.items():
+                self.timings[stage] = self.timings.get(stage, 0) + seconds
+
+        if self.frame_workers > 1:
+            with ThreadPoolExecutor(max_workers=self.frame_workers) as executor:
+                pending = deque()
+
+                for frame in decoded_frames():
+                    pending.append(executor.submit(self.transform_frame, frame))
+
+                    if len(pending) >= self.frame_workers * 2:
+                        add_frame(pending.popleft().result())
+
+                for future in pending:
+                    add_frame(future.result())
+        else:
+            for frame in decoded_frames():
+                add_frame(self.transform_frame(frame))
+
+        self.img = frames[0]
+        self.save_options['append_images'] = frames[1:]
+        self.save_options['duration'] = durations
+
+    def transform_frame(self, frame: Image.Image) -> tuple:
+        """
+        Run the plan on a single decoded frame,
+        returning the transformed frame and the seconds spent in each stage.
+        """
+        frame_transformer = copy.copy(self)
+        frame_transformer.img = frame
+        frame_transformer.timings = {}
+        frame_transformer.run_plan()
+
+        return frame_transformer.img, frame_transformer.timings
+
+    def compile_plan(self) -> List[TransformStep]:
+        """
+        Turn the options into the minimal list of steps to run.
+
+        Steps are built in pipeline order, geometry (fit + trim) ahead of the filters
+        so they run on as few pixels as possible. Values that mean the same thing are
+        merged into one step (brightness and contrast share a lookup table, rotations
+        are taken modulo 360), then every step that would leave the image unchanged
+        is dropped.
+
+        Only the header has been read at this point, so steps are judged
+        from `original_size` and the image mode.
+        """
+        steps = self._build_steps()
+
+        return [step for step in steps if not self._is_identity_step(step)]
+
+    def describe_plan(self) -> str:
+        return ' -> '.join(str(step) for step in self.plan) or 'no-op'
+
+    def _build_steps(self) -> List[TransformStep]:
+        """
+        Every step the options ask for, in the order they are applied.
+        """
+        steps = []
+
+        if fit_option := self.config.fit:
+            width, height = self._get_dimensions(
+                width=self.config.prepared_width,
+                height=self.config.prepared_height
+            )
+            args = {'width': width, 'height': height}
+
+            if fit_option in [FitEnum.COVER, FitEnum.CROP]:
+                args['gravity'] = self.config.gravity
+
+            if fit_option is FitEnum.PAD:
+                args['color'] = self.config.background
+
+            steps.append(TransformStep(fit_option.value, 'resize', args))
+
+        steps.append(TransformStep('trim', 'resize'))
+
+        if self.config.background:
+            steps.append(TransformStep('fill_background_color', 'effects'))
+
+        steps.append(TransformStep('blur', 'effects'))
+
+        # 0 is treated as the original image for both.
+        steps.append(TransformStep('adjust_color', 'effects', {
+            'brightness': self.config.brightness or 1,
+            'contrast': self.config.contrast or 1,
+        }))
+
+        steps.append(TransformStep('sharpen', 'effects'))
+        steps.append(TransformStep('rotate', 'effects', {'angle': (self.config.rotate or 0) % 360}))
+
+        return steps
+
+    def _is_identity_step(self, step: TransformStep) -> bool:
+        """
+        True if running `step` would give back the same pixels.
+        """
+        if step.name == 'scale_down':
+            return self._get_scale_down_size(step.args['width'], step.args['height']) == self.original_size
+
+        if step.name == 'contain':
+            return self._get_contain_size(step.args['width'], step.args['height']) == self.original_size
+
+        if step.name in ['cover', 'pad']:
+            return (step.args['width'], step.args['height']) == self.original_size
+
+        if step.name == 'crop':
+            # Never enlarged, so a target at least as big as the original keeps it as is.
+            orig_width, orig_height = self.original_size
+            return step.args['width'] >= orig_width and step.args['height'] >= orig_height
+
+        if step.name == 'trim':
+            return not self.config.trim
+
+        if step.name == 'fill_background_color':
+            # Frames of an animation can have transparency even if the first one doesn't.
+            return self.img.mode not in TRANSPARENT_MODES and not self.is_animated
+
+        if step.name == 'blur':
+            return not self.config.blur
+
+        if step.name == 'adjust_color':
+            return step.args['brightness'] == 1 and step.args['contrast'] == 1
+
+        if step.name == 'sharpen':
+            # A factor of 1.0 blends the image with itself.
+            return self.config.sharpen in [None, 0, 1]
+
+        if step.name == 'rotate':
+            return step.args['angle'] == 0
+
+        return False
+
+    @contextmanager
+    def timed(self, stage: str):
+        """
+        Add the wall time spent in a block to `timings[stage]`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] = self.timings.get(stage, 0) + time.perf_counter() - start
 
     def process_polish_image(self, original_img: io.BytesIO) -> io.BytesIO:
         """
@@ -296,22 +648,91 @@ class ImageTransformer:
         """
         self.transform()
 
-        self.save_options['quality'] = self.config.quality
-
         # Pillow does not save EXIF metadata on JPG, PNG, WEBP, TIFF, and n/a to GIFs.
         # If the metadata option is true, explicitly pass exif save option.
         if self.config.metadata:
-            save_options['exif'] = self.img.getexif()
+            self.save_options['exif'] = self.img.getexif()
+
+        if self.config.quality != 'auto':
+            self.quality = self.config.quality
+        elif self.quality is None:
+            with self.timed('quality_search'):
+                self.quality, buffer = self.search_quality()
+
+            # The trial encode at the chosen quality is the output.
+            if buffer is not None:
+                return buffer
+
+        self.save_options['quality'] = self.quality
+
+        with self.timed('encode'):
+            return self.save_to_buffer()
+
+    def search_quality(self) -> Tuple[int, Optional[io.BytesIO]]:
+        """
+        Choose the encoder quality for `quality=auto`, returning it along with
+        the trial encode made at that quality, if any.
+
+        With `target_bytes` it's the highest quality that fits in the budget,
+        otherwise the lowest quality at least `target_ssim` similar to the image
+        before encoding. Each round encodes `quality_search_workers` qualities
+        spread over the remaining range at once, a bisection with one worker,
+        until the range closes or `AUTO_QUALITY_MAX_TRIALS` encodes are made.
+
+        Lossless formats and animations aren't searched, they get the default quality.
+        """
+        if self.save_options['format'] not in LOSSY_SAVE_FORMATS or self.save_options.get('save_all'):
+            return ImageOptions.__fields__['quality'].default, None
+
+        target_bytes = self.config.target_bytes
+        target_ssim = self.config.target_ssim or AUTO_QUALITY_TARGET_SSIM
+
+        def check(quality: int) -> Tuple[bool, io.BytesIO]:
+            # Pillow keeps the save options on the image, so each trial saves its own shallow copy.
+            buffer = io.BytesIO()
+            copy.copy(self.img).save(buffer, **{**self.save_options, 'quality': quality})
+
+            # Both checks only start passing as the quality goes up.
+            if target_bytes:
+                passed = buffer.tell() > target_bytes
+            else:
+                buffer.seek(0)
+                passed = get_ssim(self.img, Image.open(buffer)) >= target_ssim
+
+            buffer.seek(0)
+            return passed, buffer
+
+        # Qualities up to `low` fail the check, from `high` on they pass.
+        low, high = AUTO_QUALITY_MIN - 1, AUTO_QUALITY_MAX + 1
+        trials = {}
+
+        with ThreadPoolExecutor(max_workers=self.quality_search_workers) as executor:
+            while high - low > 1 and len(trials) < AUTO_QUALITY_MAX_TRIALS:
+                count = min(self.quality_search_workers, high - low - 1, AUTO_QUALITY_MAX_TRIALS - len(trials))
+                qualities = sorted({low + round((high - low) * i / (count + 1)) for i in range(1, count + 1)})
+
+                for quality, (passed, buffer) in zip(qualities, executor.map(check, qualities)):
+                    trials[quality] = buffer
+
+                    if passed:
+                        high = min(high, quality)
+                    else:
+                        low = max(low, quality)
+
+        quality = max(low, AUTO_QUALITY_MIN) if target_bytes else min(high, AUTO_QUALITY_MAX)
+        logger.debug('quality=auto chose %d for %s after %d trials', quality, self.transformed_filename, len(trials))
 
-        return self.save_to_buffer()
+        return quality, trials.get(quality)
 
     def _populate_base_save_options(self):
         """
         Store common save options.
         """
+        save_format = self.get_save_format()
+
         self.save_options = {
-            'format': self.get_save_format(),
-            'optimize': True  # has no effect on webp formats
+            'format': save_format,
+            **ENCODE_PROFILES[self.encode_profile].get(save_format, {})
         }
 
         # By default, only the first frame of an animated image is saved,
@@ -319,6 +740,9 @@ class ImageTransformer:
         if not self.should_freeze_frame and self.is_animated:
             self.save_options['save_all'] = True
 
+            if 'loop' in self.img.info:
+                self.save_options['loop'] = self.img.info['loop']
+
         # Setting disposal allows transparent gifs to restore background color
         # at the start of each frame; this avoids previous frames from "lingering"
         # throughout the animation.
@@ -330,8 +754,7 @@ class ImageTransformer:
 
     @staticmethod
     def save_buffer_to_file(filename, buffer):
-        with open(filename, 'wb') as output_file:
-            output_file.write(buffer.getbuffer())
+        write_file_atomic(filename, buffer.getbuffer())
 
     def save_to_buffer(self) -> io.BytesIO:
         buffer = io.BytesIO()
@@ -341,53 +764,81 @@ class ImageTransformer:
         buffer.seek(0)
         return buffer
 
-    def apply_resize(self):
+    def reduce_on_decode(self):
         """
-        Fit options + trim
+        Decode the image at a reduced size when the requested output is
+        much smaller than the original.
+
+        JPEGs are decoded directly at 1/2, 1/4 or 1/8 scale with draft mode,
+        other formats are reduced by an integer factor right after decoding.
+        The image is always kept at least `REDUCING_GAP` times larger than
+        the target, and the fit functions size their output from `original_size`,
+        so output dimensions are the same as decoding the full image.
         """
-        if fit_option := self.config.fit:
-            fit_func = getattr(self, self.config.fit.value)
+        if self.img.format == 'JPEG':
+            self.draft()
+            return
 
-            width, height = self._get_dimensions(
-                width=self.config.prepared_width,
-                height=self.config.prepared_height
-            )
+        # Averaging palette indices would produce garbage colors.
+        scale = self.get_decode_scale()
+        factor = int(scale // REDUCING_GAP) if scale else 1
+        if factor > 1 and self.img.mode in ('RGB', 'RGBA', 'L', 'LA'):
+            self.img = self.img.reduce(factor)
 
-            if fit_option in [FitEnum.SCALE_DOWN, FitEnum.CONTAIN]:
-                fit_func(width=width, height=height)
-            
-            if fit_option in [FitEnum.COVER, FitEnum.CROP]:
-                fit_func(width=width, height=height, gravity=self.config.gravity)
-            
-            if fit_option is FitEnum.PAD:
-                fit_func(width=width, height=height, color=self.config.background)
+    def draft(self) -> None:
+        """
+        Set a JPEG to decode at the smallest scale that `reduce_on_decode` allows.
+        Does nothing once the image is decoded.
 
-        if self.config.trim:
-            self.trim()
+        docs: https://pillow.readthedocs.io/en/stable/reference/Image.html#PIL.Image.Image.draft
+        """
+        if self.img.format != 'JPEG' or not (scale := self.get_decode_scale()):
+            return
+
+        img_width, img_height = self.img.size
+        reduced_size = (
+            int(img_width / scale * REDUCING_GAP),
+            int(img_height / scale * REDUCING_GAP)
+        )
+
+        self.img.draft(None, reduced_size)
 
-    def apply_effects(self):
+    def get_decode_scale(self) -> Optional[float]:
         """
-        filters (blur, brightness, contrast, sharpen) + rotate
+        How many times larger than the requested output the image is,
+        None when it's not large enough to be reduced on decode.
         """
-        if self.config.background:
-            self.fill_background_color()
+        if not self.config.fit:
+            return None
 
-        for effect in ['blur', 'brightness', 'contrast', 'sharpen', 'rotate']:
-            if getattr(self.config, effect, None):
-                effect_func = getattr(self, effect)
-                effect_func()
+        width, height = self._get_dimensions(
+            width=self.config.prepared_width,
+            height=self.config.prepared_height
+        )
+
+        # `cover` and `crop` only keep part of the image, so the scale is set by the
+        # dimension that is cropped least; the other fit options by the dimension shrunk most.
+        img_width, img_height = self.img.size
+        scales = (img_width / width, img_height / height)
+        scale = min(scales) if self.config.fit in [FitEnum.COVER, FitEnum.CROP] else max(scales)
+
+        # Never reduce if the image will be enlarged or is already close to the target size.
+        if scale < REDUCING_GAP * 2:
+            return None
+
+        return scale
 
     def _get_dimensions(self, width: int = None, height: int = None) -> tuple:
         """
         Calculate new dimensions based on the original image's aspect ratio and a width or height.
         """
         if not width and not height:
-            return self.img.size
+            return self.original_size
 
         if width and height:
             return (width, height)
         
-        orig_width, orig_height = self.img.size
+        orig_width, orig_height = self.original_size
 
         # calculate new height
         if width and not height:
@@ -410,9 +861,37 @@ class ImageTransformer:
             - if all larger dimensions -> original image
             - if smaller + larger dimension -> scaled down image according to smaller dimension
         
+        The target size is taken from `original_size` (same rounding as `Image.thumbnail`),
+        so it doesn't change if the image was reduced on decode.
+
         docs: https://pillow.readthedocs.io/en/stable/reference/Image.html#PIL.Image.Image.thumbnail
         """
-        self.img.thumbnail((width, height))
+        size = self._get_scale_down_size(width=width, height=height)
+
+        if self.img.size != size:
+            self.img = self.img.resize(size, Image.Resampling.BICUBIC, reducing_gap=REDUCING_GAP)
+
+    def _get_scale_down_size(self, width: int, height: int) -> tuple:
+        """
+        Output size of `scale_down`, the original size if the image fits already.
+        """
+        orig_width, orig_height = self.original_size
+        width, height = math.floor(width), math.floor(height)
+
+        if width >= orig_width and height >= orig_height:
+            return self.original_size
+
+        aspect = orig_width / orig_height
+
+        def round_aspect(number, key):
+            return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+        if width / height >= aspect:
+            width = round_aspect(height * aspect, key=lambda n: abs(aspect - n / height))
+        else:
+            height = round_aspect(width / aspect, key=lambda n: 0 if n == 0 else abs(aspect - width / n))
+
+        return (width, height)
     
     def contain(self, width: int, height: int) -> None:
         """
@@ -424,9 +903,29 @@ class ImageTransformer:
             - all larger dimensions -> scaled up image
             - smaller + larger dimension -> scaled down image according to smaller dimension
 
+        The target size is taken from `original_size` (same rounding as `ImageOps.contain`),
+        so it doesn't change if the image was reduced on decode.
+
         docs: https://pillow.readthedocs.io/en/stable/reference/ImageOps.html#PIL.ImageOps.contain
         """
-        self.img = ImageOps.contain(self.img, (width, height))
+        size = self._get_contain_size(width=width, height=height)
+
+        self.img = self.img.resize(size, Image.Resampling.BICUBIC)
+
+    def _get_contain_size(self, width: int, height: int) -> tuple:
+        """
+        Output size of `contain`.
+        """
+        orig_width, orig_height = self.original_size
+        im_ratio = orig_width / orig_height
+        dest_ratio = width / height
+
+        if im_ratio > dest_ratio:
+            height = round(orig_height / orig_width * width)
+        elif im_ratio < dest_ratio:
+            width = round(orig_width / orig_height * height)
+
+        return (width, height)
 
     def cover(self, width: int, height: int, gravity: GravityEnum = GravityEnum.CENTER) -> None:
         """
@@ -438,7 +937,7 @@ class ImageTransformer:
         # Get Pillow centering position from gravity
         centering = self._get_centering_from_gravity(width=width, height=height, gravity=gravity)
 
-        self.img = ImageOps.fit(self.img, (width, height), centering=gravity)
+        self.img = ImageOps.fit(self.img, (width, height), centering=centering)
 
     def crop(self, width: int, height: int, gravity: GravityEnum = GravityEnum.CENTER) -> None:
         """
@@ -454,7 +953,7 @@ class ImageTransformer:
         
         docs: https://pillow.readthedocs.io/en/stable/reference/ImageOps.html#PIL.ImageOps.fit
         """
-        orig_width, orig_height = img.size
+        orig_width, orig_height = self.original_size
 
         # Take smallest height and width
         width, height = min(orig_width, width), min(orig_height, height)
@@ -491,10 +990,10 @@ class ImageTransformer:
         Return the Pillow centering tuple based on gravity option
         and aspect ratio of new image.
         """
-        orig_aspect_ratio = self._get_aspect_ratio_factor(width=img.size[0], height=img.size[1])
+        orig_aspect_ratio = self._get_aspect_ratio_factor(width=self.original_size[0], height=self.original_size[1])
         new_aspect_ratio = self._get_aspect_ratio_factor(width=width, height=height)
 
-        if gravity is Gravity.CENTER:
+        if gravity is GravityEnum.CENTER:
             return CENTER_CROP
 
         if new_aspect_ratio > orig_aspect_ratio:
@@ -525,6 +1024,73 @@ class ImageTransformer:
         """
         self.img = self.img.filter(ImageFilter.GaussianBlur(self.config.blur))
 
+    def adjust_color(self, brightness: float = 1, contrast: float = 1) -> None:
+        """
+        Applies brightness and contrast in a single lookup table pass.
+
+        Both are point operations, so they are combined into one table per band
+        instead of blending against a full size degenerate image for each step
+        like `ImageEnhance` does. Values are truncated and clipped the same way
+        as `Image.blend`. Modes that can't use a table fall back to `brightness`
+        and `contrast`.
+
+        docs: https://pillow.readthedocs.io/en/stable/reference/Image.html#PIL.Image.Image.point
+        """
+        # Same as `brightness` and `contrast`, 0 is treated as the original image.
+        brighten_amount = brightness or 1
+        contrast_amount = contrast or 1
+
+        if brighten_amount == 1 and contrast_amount == 1:
+            return
+
+        if self.img.mode not in POINT_LUT_MODES:
+            if self.config.brightness:
+                self.brightness()
+            if self.config.contrast:
+                self.contrast()
+            return
+
+        lut = [self._clip8(value * brighten_amount) for value in range(256)]
+
+        if contrast_amount != 1:
+            mean = self._get_mean_luminance(lut)
+            lut = [self._clip8(mean + contrast_amount * (value - mean)) for value in lut]
+
+        bands = self.img.getbands()
+        alpha_lut = list(range(256)) if 'A' in bands else []
+        color_bands = len(bands) - (1 if alpha_lut else 0)
+
+        self.img = self.img.point(lut * color_bands + alpha_lut)
+
+    def _get_mean_luminance(self, lut: list) -> int:
+        """
+        Mean "L" value of the image after applying `lut`, the gray level
+        `ImageEnhance.Contrast` blends against.
+
+        Computed from the band histograms instead of converting the image.
+        """
+        histogram = self.img.histogram()
+        pixels = self.img.width * self.img.height
+
+        if self.img.mode in ('L', 'LA'):
+            weights = (1,)
+        else:
+            weights = (0.299, 0.587, 0.114)  # ITU-R 601-2 luma, same as `convert("L")`
+
+        mean = 0
+        for band, weight in enumerate(weights):
+            band_histogram = histogram[band * 256:(band + 1) * 256]
+            mean += weight * sum(count * lut[value] for value, count in enumerate(band_histogram)) / pixels
+
+        return int(mean + 0.5)
+
+    @staticmethod
+    def _clip8(value: float) -> int:
+        """
+        Truncate and clip a value to the 0 - 255 range.
+        """
+        return min(max(int(value), 0), 255)
+
     def brightness(self) -> None:
         """
         Applies brightness to image.
@@ -587,21 +1153,23 @@ class ImageTransformer:
 
         self.img = filter.enhance(self.config.sharpen)
 
-    def rotate(self) -> None:
+    def rotate(self, angle: int = None) -> None:
         """
         Return a rotated version of the image.
         Valid rotation degrees are 90, 180, or 270.
 
         docs: https://pillow.readthedocs.io/en/stable/reference/Image.html#PIL.Image.Image.rotate
         """
-        self.img = self.img.rotate(angle=self.config.rotate, expand=True)
+        angle = self.config.rotate if angle is None else angle
+
+        self.img = self.img.rotate(angle=angle, expand=True)
 
     def freeze_animated_image(self) -> None:
         """
         Freeze the first frame of an animated image.
 
-        This is mostly a precaution to ensure an animated
-        image is at the first frame.         
+        The image is still at the first frame after `Image.open`,
+        so no other frame is decoded.
         """
         self.img.seek(0)
 
@@ -618,7 +1186,7 @@ class ImageTransformer:
         """
         Fill transparent images with a background color.
         """
-        if self.img.mode in ("RGBA", "LA"):
+        if self.img.mode in TRANSPARENT_MODES:
             background = Image.new(
                 self.img.mode[:-1],
                 self.img.size,
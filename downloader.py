@@ -0,0 +1,117 @@
+import asyncio
+from dataclasses import dataclass, field
+import logging
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from utils import atomic_file
+
+try:
+    import h2  # noqa: F401, needed for `http2`
+except ImportError:
+    h2 = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadTooLargeError(Exception):
+    """
+    Raised when a download is bigger than the downloader's `max_bytes`.
+    """
+
+
+@dataclass
+class Downloader:
+    """
+    Application wide HTTP client for downloading originals.
+
+    Connections are kept alive and reused across downloads, at most
+    `max_connections_per_host` downloads run against a host at once,
+    and bodies are streamed to disk so memory stays flat for large originals.
+
+    `transport` points the client somewhere other than the network,
+    ex. an `httpx.MockTransport` or a local stand-in in tests.
+    """
+    max_connections_per_host: int = 8
+    max_keepalive_connections: int = 32
+    max_bytes: int = 50 * 1024 * 1024
+    timeout: float = 30.0
+    connect_timeout: float = 5.0
+    http2: bool = False
+    chunk_size: int = 64 * 1024
+    transport: Optional[httpx.AsyncBaseTransport] = None
+
+    downloaded: int = 0
+    rejected: int = 0
+
+    _client: Optional[httpx.AsyncClient] = field(default=None, repr=False)
+    _host_limits: Dict[str, asyncio.Semaphore] = field(default_factory=dict, repr=False)
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            http2 = self.http2
+
+            if http2 and h2 is None:
+                logger.warning('http2 is enabled but the h2 package is not installed, using HTTP/1.1')
+                http2 = False
+
+            self._client = httpx.AsyncClient(
+                http2=http2,
+                timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(max_keepalive_connections=self.max_keepalive_connections),
+                transport=self.transport
+            )
+
+        return self._client
+
+    async def download(self, url: str, filename: str, headers: Optional[dict] = None) -> int:
+        """
+        Stream `url` to `filename` and return the number of bytes written.
+
+        The file is written atomically, nothing is left behind if the response
+        is an error or grows past `max_bytes`.
+        """
+        host = urlsplit(url).hostname
+        limit = self._host_limits.setdefault(host, asyncio.Semaphore(self.max_connections_per_host))
+
+        async with limit, self.client.stream('GET', url, headers=headers) as resp:
+            resp.raise_for_status()
+
+            content_length = resp.headers.get('content-length')
+            if content_length and int(content_length) > self.max_bytes:
+                self.rejected += 1
+                raise DownloadTooLargeError(f'{url} is {content_length} bytes, the limit is {self.max_bytes}')
+
+            size = 0
+
+            with atomic_file(filename) as f:
+                async for chunk in resp.aiter_bytes(self.chunk_size):
+                    size += len(chunk)
+
+                    # Content-Length can be missing or describe a compressed body.
+                    if size > self.max_bytes:
+                        self.rejected += 1
+                        raise DownloadTooLargeError(f'{url} is over the {self.max_bytes} byte limit')
+
+                    f.write(chunk)
+
+        self.downloaded += 1
+        logger.debug('Downloaded %s to %s (%d bytes)', url, filename, size)
+
+        return size
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict:
+        return {
+            'downloaded': self.downloaded,
+            'rejected': self.rejected,
+            'hosts': len(self._host_limits),
+        }
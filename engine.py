@@ -0,0 +1,184 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+import multiprocessing
+import os
+import time
+from typing import Callable, Optional, Tuple
+
+from PIL import Image
+
+from cache import DecodedImageCache
+from config import EncodeProfileEnum, ImageOptions, ImageTransformer, get_gif_loading_strategy, gif_loading_strategy
+from utils import get_filename_extension
+
+
+# Set in each worker process by `_init_worker`.
+DECODED_ORIGINALS: Optional[DecodedImageCache] = None
+
+# Hits, misses and evictions of the decoded original caches, summed across workers.
+_DECODED_ORIGINALS_STATS = None
+
+
+class TransformQueueFullError(Exception):
+    """
+    Raised when the transform engine can't accept any more work.
+    """
+
+
+def _init_worker(decoded_cache_max_bytes: int, decoded_stats) -> None:
+    """
+    Import and register every Pillow plugin once when a worker starts,
+    instead of lazily on the first image each worker opens,
+    and set up the worker's cache of decoded originals.
+    """
+    global DECODED_ORIGINALS, _DECODED_ORIGINALS_STATS
+
+    Image.init()
+
+    DECODED_ORIGINALS = DecodedImageCache(max_bytes=decoded_cache_max_bytes)
+    _DECODED_ORIGINALS_STATS = decoded_stats
+
+
+def decode_original(transformer: ImageTransformer) -> float:
+    """
+    Decode the transformer's image through the worker's decoded original cache,
+    so variants of the same image only pay the decode once per worker.
+    JPEGs for a large downscale are drafted first, the cache keeps them at that size.
+
+    Returns the seconds spent decoding, without a cache the transform decodes the image.
+    """
+    if DECODED_ORIGINALS is None:
+        return 0.0
+
+    transformer.draft()
+
+    before = (DECODED_ORIGINALS.hits, DECODED_ORIGINALS.misses, DECODED_ORIGINALS.evictions)
+    transformer.img, decode_seconds = DECODED_ORIGINALS.load(transformer.img)
+    after = (DECODED_ORIGINALS.hits, DECODED_ORIGINALS.misses, DECODED_ORIGINALS.evictions)
+
+    with _DECODED_ORIGINALS_STATS.get_lock():
+        for i, (old, new) in enumerate(zip(before, after)):
+            _DECODED_ORIGINALS_STATS[i] += new - old
+
+    return decode_seconds
+
+
+def render_variant(
+    img_name: str,
+    options: ImageOptions,
+    transformed_img_name: str,
+    original_size: Optional[tuple] = None,
+    frame_workers: int = 1,
+    encode_profile: EncodeProfileEnum = EncodeProfileEnum.BALANCED,
+    quality: Optional[int] = None,
+    quality_search_workers: int = 1
+) -> Tuple[bytes, dict, Optional[int]]:
+    """
+    Open, transform and encode an image, returning the encoded bytes,
+    the seconds spent in each stage and the encoder quality used.
+
+    `original_size` is passed when `img_name` is a larger cached variant
+    rather than the original itself. `frame_workers` threads transform
+    the frames of animated images. `encode_profile` is used unless
+    the options pick a profile.
+
+    With `quality=auto`, `quality_search_workers` threads run the trial encodes
+    of the quality search, which is skipped when `quality` was chosen before.
+
+    Runs inside a worker process, so only picklable arguments are passed in.
+    """
+    strategy = get_gif_loading_strategy(options, get_filename_extension(transformed_img_name))
+
+    with gif_loading_strategy(strategy):
+        start = time.perf_counter()
+        transformer = ImageTransformer(
+            config=options,
+            img=Image.open(img_name),
+            transformed_filename=transformed_img_name,
+            original_size=original_size,
+            frame_workers=frame_workers,
+            encode_profile=options.profile or encode_profile,
+            quality=quality,
+            quality_search_workers=quality_search_workers
+        )
+        decode_seconds = decode_original(transformer)
+        timings = {'open': time.perf_counter() - start - decode_seconds, 'decode': decode_seconds}
+
+        buffer = transformer.process_transform_image()
+
+        for stage, seconds in transformer.timings.items():
+            timings[stage] = timings.get(stage, 0) + seconds
+
+    return buffer.getvalue(), timings, transformer.quality
+
+
+@dataclass
+class TransformEngine:
+    """
+    Runs CPU heavy transforms in a dedicated process pool.
+
+    At most `max_workers` transforms run at once and up to `max_queue` more
+    wait for a worker; anything beyond that is rejected with
+    `TransformQueueFullError` so callers can shed load.
+    """
+    max_workers: int = field(default_factory=os.cpu_count)
+    max_queue: int = 64
+    decoded_cache_max_bytes: int = 512 * 1024 * 1024  # split evenly between the workers
+
+    pending: int = 0
+    rejected: int = 0
+
+    _executor: Optional[ProcessPoolExecutor] = field(default=None, repr=False)
+    _decoded_stats: multiprocessing.Array = field(default_factory=lambda: multiprocessing.Array('q', 3), repr=False)
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                initializer=_init_worker,
+                initargs=(self.decoded_cache_max_bytes // self.max_workers, self._decoded_stats)
+            )
+
+        return self._executor
+
+    async def submit(self, func: Callable, *args, **kwargs):
+        """
+        Run `func` in a worker process and wait for its result.
+
+        `pending` is only touched from the event loop, so it needs no lock.
+        """
+        if self.pending >= self.max_workers + self.max_queue:
+            self.rejected += 1
+            raise TransformQueueFullError('Transform queue is full')
+
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+        finally:
+            self.pending -= 1
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        hits, misses, evictions = self._decoded_stats[:]
+        total = hits + misses
+
+        return {
+            'workers': self.max_workers,
+            'max_queue': self.max_queue,
+            'pending': self.pending,
+            'rejected': self.rejected,
+            'decoded_originals': {
+                'hits': hits,
+                'misses': misses,
+                'evictions': evictions,
+                'hit_rate': hits / total if total else 0.0,
+            },
+        }
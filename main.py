@@ -1,114 +1,341 @@
+import asyncio
+from functools import lru_cache
 import io
-from collections import OrderedDict
 from glob import glob
 import json
+import logging
+import mimetypes
+import os
 from pathlib import Path
-from typing import Union, Optional
+import time
+from typing import List, Tuple, Union, Optional
 from urllib.parse import parse_qs, urlencode, urlparse
 
-import httpx
-from fastapi import Depends, FastAPI, Request, Body, Query
+from fastapi import BackgroundTasks, Depends, FastAPI, Request, Body, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse, RedirectResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, RedirectResponse, Response, StreamingResponse
 from PIL import Image
-from pydantic import BaseModel, Field, FilePath, HttpUrl, root_validator
+from pydantic import BaseModel, Field, FilePath, HttpUrl, ValidationError, parse_obj_as, root_validator
 
 
-from config import ImageOptions, ImageTransformer
+from cache import CachedVariant, DiskCache, QualityCache, SingleFlight, VariantAncestry, VariantCache
+from config import EncodeProfileEnum, ImageOptions
+from downloader import Downloader, DownloadTooLargeError
+from engine import TransformEngine, TransformQueueFullError, render_variant
+from mapping import ImageMapping
+from metrics import Histogram, format_server_timing, render_cache_metrics, render_metric
+from naming import get_extension, get_query_param_dict, get_variant_name, is_passthrough, str2bool
+from utils import decode_cursor, encode_cursor, get_etag, has_metadata, is_not_modified
 
 
-IMAGE_URL_MAPPING = {}
+logger = logging.getLogger(__name__)
+
+LOG_LEVEL = logging.INFO
+# Local original path -> foolcdn url, imported once from the legacy JSON file.
+IMAGE_URL_MAPPING_DB = 'image_mapping.sqlite3'
 IMAGE_URL_MAPPING_FILE = 'image_mapping.json'
-VALID_PARAMS = list(ImageOptions.__fields__.keys())
+IMAGE_URL_MAPPING = ImageMapping(path=IMAGE_URL_MAPPING_DB)
+# /compare pagination, these query params aren't passed on to the image urls.
+COMPARE_PAGE_SIZE = 100
+COMPARE_MAX_PAGE_SIZE = 1000
+COMPARE_PARAMS = ['cursor', 'limit', 'prefix']
 LOCAL_ORIGINAL_IMG_DIRECTORY = 'tmf-original'
 LOCAL_TRANSFORMED_IMG_DIRECTORY = 'tmf-transformed'
+CACHE_CONTROL = 'public, max-age=86400'
+VARIANT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+VARIANT_CACHE = VariantCache(max_bytes=VARIANT_CACHE_MAX_BYTES)
+DISK_CACHE_MAX_BYTES = 20 * 1024 * 1024 * 1024
+DISK_CACHE = DiskCache(directory=LOCAL_TRANSFORMED_IMG_DIRECTORY, max_bytes=DISK_CACHE_MAX_BYTES)
+TRANSFORMS_IN_FLIGHT = SingleFlight()
+# Resample `scale_down` and `contain` variants from larger cached variants when possible.
+# Only lossless or quality >= 90 variants are resampled from, so JPEG and WebP variants
+# at the default quality of 80, including the pregenerated ones, are never ancestors:
+# compressing twice drifts too far from resampling the original (see test_derivation.py).
+VARIANT_DERIVATION_ENABLED = True
+VARIANT_DERIVATION_MIN_QUALITY = 90
+VARIANT_DERIVATION_MIN_SCALE = 2.0
+VARIANT_ANCESTRY = VariantAncestry(
+    min_quality=VARIANT_DERIVATION_MIN_QUALITY,
+    min_scale=VARIANT_DERIVATION_MIN_SCALE
+)
+# Variants generated in the background when an image is downloaded:
+# a 2x/4x/8x downscale pyramid plus standard widths, in WebP and the original format.
+PREGENERATE_ON_DOWNLOAD = True
+PREGENERATE_PYRAMID_FACTORS = (2, 4, 8)
+PREGENERATE_WIDTHS = (300, 500, 800, 1200)
+# Encoder effort when a request doesn't pick a `profile`: interactive misses
+# and pregenerated variants, which nobody is waiting on.
+ENCODE_PROFILE = EncodeProfileEnum.BALANCED
+PREGENERATE_ENCODE_PROFILE = EncodeProfileEnum.MAX
+# Qualities chosen by quality=auto, so re-rendering a variant skips the search,
+# and the threads per transform running its trial encodes.
+AUTO_QUALITY_CACHE_MAX_ENTRIES = 100_000
+AUTO_QUALITY_CACHE = QualityCache(max_entries=AUTO_QUALITY_CACHE_MAX_ENTRIES)
+QUALITY_SEARCH_WORKERS = 1
+# Originals whose metadata was checked for /transform passthrough, by identity.
+PASSTHROUGH_CHECK_CACHE_SIZE = 10_000
+TRANSFORM_QUEUE_SIZE = 64
+TRANSFORM_RETRY_AFTER_SECONDS = 1
+# Pixel data of decoded originals kept in memory, in total across the transform workers.
+DECODED_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Threads per transform for the frames of animated images, on top of the engine's worker processes.
+ANIMATION_FRAME_WORKERS = 1
+TRANSFORM_ENGINE = TransformEngine(max_queue=TRANSFORM_QUEUE_SIZE, decoded_cache_max_bytes=DECODED_CACHE_MAX_BYTES)
+# One pooled client for every /download, connections to the foolcdn hosts are reused.
+DOWNLOAD_ALLOWED_HOSTS = ['g.foolcdn.com', 'm.foolcdn.com', 'staging.m.foolcdn.com', 'staging.g.foolcdn.com']
+DOWNLOAD_HEADERS = {'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7'}
+DOWNLOAD_MAX_BYTES = 50 * 1024 * 1024
+DOWNLOAD_MAX_CONNECTIONS_PER_HOST = 8
+DOWNLOAD_TIMEOUT_SECONDS = 30
+DOWNLOAD_HTTP2 = False  # needs the h2 package
+DOWNLOADER = Downloader(
+    max_connections_per_host=DOWNLOAD_MAX_CONNECTIONS_PER_HOST,
+    max_bytes=DOWNLOAD_MAX_BYTES,
+    timeout=DOWNLOAD_TIMEOUT_SECONDS,
+    http2=DOWNLOAD_HTTP2
+)
+# Downloads running at once across all /ingest batches, on top of the per-host limit.
+INGEST_MAX_CONCURRENCY = 16
+INGEST_LIMIT = asyncio.Semaphore(INGEST_MAX_CONCURRENCY)
+
+# Disk cache writes still running after their response was sent
+BACKGROUND_WRITES = set()
+
+STAGE_SECONDS = Histogram(
+    name='tmf_transform_stage_seconds',
+    documentation='Seconds spent in each stage of transforming an image.',
+    label_name='stage'
+)
+REQUEST_SECONDS = Histogram(
+    name='tmf_transform_request_seconds',
+    documentation='Seconds to serve a /transform request, by how it was served.',
+    label_name='result'
+)
 
 
 def populate_image_mapping() -> None:
     """
-    Load json file to image mapping dict.
+    Import the json mapping file into the image mapping store, the first time only.
     """
-    with open(IMAGE_URL_MAPPING_FILE) as f:
-        global IMAGE_URL_MAPPING
-        IMAGE_URL_MAPPING = json.load(f)
+    IMAGE_URL_MAPPING.import_json(IMAGE_URL_MAPPING_FILE)
 
 
 def save_image_to_mapping(local_file_path: str, image_url: str) -> None:
     """
-    Save image to mapping by updating mapping dict and updating json file.
+    Save image to mapping.
+    """
+    IMAGE_URL_MAPPING.set(local_file_path, image_url)
+
+
+@lru_cache(maxsize=PASSTHROUGH_CHECK_CACHE_SIZE)
+def original_has_metadata(img_name: str, mtime_ns: int, size: int) -> bool:
+    """
+    Check an original for metadata (see `has_metadata`), reading it only once
+    per modification time and size, so a replaced original is read again.
+    """
+    return has_metadata(Path(img_name).read_bytes())
+
+
+def get_download_target(image_url: HttpUrl) -> Tuple[str, str]:
+    """
+    Return the url to download an image from, without its query string,
+    and the local file to save it to.
+
+    Raises `ValueError` if the url's path doesn't end in a file name.
     """
-    IMAGE_URL_MAPPING[local_file_path] = image_url
+    name = Path(image_url.path or '').name
+
+    if name in ['', '.', '..']:
+        raise ValueError(f'{image_url} has no file name')
+
+    url = f'{image_url.scheme}://{image_url.host}{image_url.path}'
+    filename = f'{LOCAL_ORIGINAL_IMG_DIRECTORY}/{name}'
 
-    with open(IMAGE_URL_MAPPING_FILE, 'w') as f:
-        json.dump(IMAGE_URL_MAPPING, f, indent=4)
+    return url, filename
 
 
 def configure():
+    logging.basicConfig(level=LOG_LEVEL)
     populate_image_mapping()
+    DISK_CACHE.load_index()
 
 
 app = FastAPI()
 configure()
+
+
+@app.on_event('shutdown')
+async def shutdown():
+    await asyncio.gather(*BACKGROUND_WRITES)
+    await DOWNLOADER.aclose()
+    TRANSFORM_ENGINE.shutdown()
+    IMAGE_URL_MAPPING.close()
+
 # app.mount("/static", StaticFiles(directory="img"), name='static')
 
-def str2bool(value) -> bool:
+def find_ancestor_variant(img_name: str, options: ImageOptions) -> Optional[Tuple[str, CachedVariant]]:
     """
-    Replacement for `distutils.strtobool` due to
-    its deprecation in Python 3.10.
+    Return the path of a cached variant that the requested variant
+    can be resampled from, and the variant itself, if any.
     """
-    true_values = ['true', 't', 'yes', 'y', '1']
-    false_values = ['false', 'f', 'no', 'n', '0']
-    value = value.lower()
-    
-    if value in true_values:
-        return True
-    if value in false_values:
-        return False
+    if not (VARIANT_DERIVATION_ENABLED and options.is_resize_only):
+        return None
+
+    ancestor = VARIANT_ANCESTRY.find(
+        img_name,
+        width=options.prepared_width,
+        height=options.prepared_height,
+        is_available=DISK_CACHE.__contains__
+    )
+
+    if ancestor and (ancestor_file := DISK_CACHE.get(ancestor.key)):
+        return ancestor_file, ancestor
 
 
-def get_query_param_dict(querystring: str) -> dict:
+def record_variant(img_name: str, options: ImageOptions, transformed_img_name: str, content: bytes, quality: int, ancestor: Optional[CachedVariant]) -> None:
     """
-    Convert a query param string into a dictionary.
+    Remember a resize only variant so later, smaller variants can be derived from it.
+    `ancestor` is the variant it was derived from, if any; derived variants are
+    recorded a generation further from the original, which keeps them from being ancestors.
     """
-    return {k: v[0] for k, v in parse_qs(querystring.lower()).items()}
-
-
-def normalize_query_params(query_params: dict) -> OrderedDict:
+    if not options.is_resize_only:
+        return
+
+    variant = Image.open(io.BytesIO(content))
+
+    if getattr(variant, 'is_animated', False):
+        return
+
+    VARIANT_ANCESTRY.add(img_name, CachedVariant(
+        key=transformed_img_name,
+        size=variant.size,
+        original_size=ancestor.original_size if ancestor else Image.open(img_name).size,
+        quality=quality,
+        extension=Path(transformed_img_name).suffix,
+        generation=ancestor.generation + 1 if ancestor else 0
+    ))
+
+
+async def transform_image(
+    img_name: str,
+    options: ImageOptions,
+    transformed_img_name: str,
+    encode_profile: EncodeProfileEnum = ENCODE_PROFILE
+) -> Tuple[bytes, dict]:
     """
-    Sort and normalize query parameters into an OrderedDict.
+    Transform an image in the transform engine and return the encoded bytes
+    and the seconds spent in each stage. The disk cache is written in the background.
+
+    `encode_profile` is used unless the options pick a profile.
+    A quality chosen by `quality=auto` before is reused instead of searched again.
     """
-    cleaned_params = {k: v for k, v in query_params.items() if k in VALID_PARAMS}
+    quality = AUTO_QUALITY_CACHE.get(transformed_img_name) if options.quality == 'auto' else None
+
+    async def render(source_img_name: str, original_size: Optional[tuple]) -> Tuple[bytes, dict, Optional[int]]:
+        return await TRANSFORM_ENGINE.submit(
+            render_variant,
+            img_name=source_img_name,
+            options=options,
+            transformed_img_name=transformed_img_name,
+            original_size=original_size,
+            frame_workers=ANIMATION_FRAME_WORKERS,
+            encode_profile=encode_profile,
+            quality=quality,
+            quality_search_workers=QUALITY_SEARCH_WORKERS
+        )
+
+    start = time.perf_counter()
+    ancestor = None
+
+    if found := find_ancestor_variant(img_name, options):
+        ancestor_file, ancestor = found
+        logger.debug('Deriving %s from %s', transformed_img_name, ancestor_file)
+
+        try:
+            content, timings, quality = await render(ancestor_file, ancestor.original_size)
+        except FileNotFoundError:
+            # Evicted or deleted since it was found, resample the original instead.
+            logger.warning('Ancestor %s of %s is missing', ancestor_file, transformed_img_name)
+            DISK_CACHE.discard(ancestor.key, ancestor_file)
+            ancestor = None
+        else:
+            VARIANT_ANCESTRY.derived += 1
+
+    if ancestor is None:
+        content, timings, quality = await render(img_name, None)
+    # Time spent waiting for a worker and passing data to and from it
+    timings['queue'] = max(time.perf_counter() - start - sum(timings.values()), 0)
+
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe(stage, seconds)
+
+    if options.quality == 'auto' and quality is not None:
+        AUTO_QUALITY_CACHE.set(transformed_img_name, quality)
+
+    # The bytes are returned right away, the disk cache is written in the background.
+    task = asyncio.create_task(
+        write_variant_to_cache(img_name, options, transformed_img_name, content, quality, ancestor)
+    )
+    BACKGROUND_WRITES.add(task)
+    task.add_done_callback(BACKGROUND_WRITES.discard)
 
-    return OrderedDict(sorted(cleaned_params.items(), key=lambda x: x[0]))
+    return content, timings
 
 
-def get_transform_options_str(normalized_query_params: OrderedDict) -> str:
+async def write_variant_to_cache(img_name: str, options: ImageOptions, transformed_img_name: str, content: bytes, quality: int, ancestor: Optional[CachedVariant]) -> None:
     """
-    Flatten query params OrderedDict into string, ex. `height_500_width_500`.
+    Atomically write a freshly transformed variant to the disk cache.
     """
-    return '_'.join((f'{k}_{v}' for k, v in normalized_query_params.items()))
+    try:
+        start = time.perf_counter()
+        output_file = await run_in_threadpool(DISK_CACHE.set, transformed_img_name, content)
+        STAGE_SECONDS.observe('cache_write', time.perf_counter() - start)
+        logger.info('Transformed %s', output_file)
 
+        await run_in_threadpool(record_variant, img_name, options, transformed_img_name, content, quality, ancestor)
+    except Exception:
+        logger.exception('Failed to write %s to the disk cache', transformed_img_name)
 
-def get_transformed_image_name(image_filename: str, transformed_options: str, extension: str = None) -> str:
+
+async def pregenerate_variants(img_name: str) -> None:
     """
-    Concatenate image name with normalized query parameters
-    to create transformed image filename.
+    Generate the default variants of a newly downloaded image,
+    so the first requests for common sizes are cache hits.
 
-    Ex. "coffee.jpg", "height_1000_width_500" -> "coffee_height_1000_width_500.webp"
+    Variants are generated one at a time, largest first, so they never
+    crowd out interactive requests in the transform engine.
     """
-    if transformed_options:
-        return f'{Path(image_filename).stem}_{transformed_options}{extension}'
+    img = await run_in_threadpool(Image.open, img_name)
 
-    return f'{Path(image_filename).stem}{extension}'
+    orig_width, _ = img.size
+    widths = {orig_width // factor for factor in PREGENERATE_PYRAMID_FACTORS}
+    widths.update(width for width in PREGENERATE_WIDTHS if width < orig_width)
 
+    extensions = dict.fromkeys(['.webp', Path(img_name).suffix])
 
-def get_extension(accept_header: str, image_filename: str, enable_webp: bool = True) -> str:
-    """
-    Returns the extension to use for transformed image.
-    """
-    if accept_header and 'image/webp' in accept_header and enable_webp:
-            return '.webp'
-    return Path(image_filename).suffix
+    stat = await run_in_threadpool(os.stat, img_name)
+
+    for width in sorted(widths, reverse=True):
+        options = ImageOptions(width=width)
+
+        for extension in extensions:
+            transformed_img_name = get_variant_name(img_name, options, extension, stat)
+
+            if transformed_img_name in DISK_CACHE:
+                continue
+
+            try:
+                await TRANSFORMS_IN_FLIGHT.do_async(
+                    transformed_img_name,
+                    transform_image,
+                    img_name=img_name,
+                    options=options,
+                    transformed_img_name=transformed_img_name,
+                    encode_profile=PREGENERATE_ENCODE_PROFILE
+                )
+            except TransformQueueFullError:
+                logger.warning('Transform queue full, skipping pregeneration of %s', transformed_img_name)
 
 
 @app.get("/")
@@ -142,58 +369,152 @@ async def root():
 
 
 @app.get("/download/{image_url:path}")
-async def download_image(image_url: HttpUrl):
-    allowed_hosts = ['g.foolcdn.com', 'm.foolcdn.com', 'staging.m.foolcdn.com', 'staging.g.foolcdn.com']
+async def download_image(image_url: HttpUrl, background_tasks: BackgroundTasks, pregenerate: bool = PREGENERATE_ON_DOWNLOAD):
+    if image_url.host not in DOWNLOAD_ALLOWED_HOSTS:
+        return JSONResponse(status_code=400, content={"error": f"Image url must be one of the valid foolcdn domains, {DOWNLOAD_ALLOWED_HOSTS}"})
 
-    if image_url.host not in allowed_hosts:
-        return JSONResponse(status_code=400, content={"error": f"Image url must be one of the valid foolcdn domains, {allowed_hosts}"})
+    try:
+        url, filename = get_download_target(image_url)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
 
-    async with httpx.AsyncClient() as client:
-        url = f'{image_url.scheme}://{image_url.host}{image_url.path}'
-        headers = {'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7'}
-        resp = await client.get(url, headers=headers)
-        resp.raise_for_status()
+    # Streamed straight to the original's file
+    try:
+        await DOWNLOADER.download(url, filename, headers=DOWNLOAD_HEADERS)
+    except DownloadTooLargeError as e:
+        return JSONResponse(status_code=413, content={"error": str(e)})
 
-    # Save image
-    filename = f'{LOCAL_ORIGINAL_IMG_DIRECTORY}/{Path(image_url.path).name}'
-    buffer = io.BytesIO(resp.content)
-    ImageTransformer.save_buffer_to_file(filename=filename, buffer=buffer)
+    # Store in mapping, SQLite may wait for another writer, so off the event loop
+    await run_in_threadpool(save_image_to_mapping, local_file_path=filename, image_url=url)
 
-    # Store in mapping
-    save_image_to_mapping(local_file_path=filename, image_url=url)
+    # Generate common variants after the redirect is sent
+    if pregenerate:
+        background_tasks.add_task(pregenerate_variants, filename)
 
     return RedirectResponse(url=f'/transform/{filename}')
 
 
+class IngestRequest(BaseModel):
+    urls: List[str]
+    pregenerate: bool = False
+
+
+async def ingest_image(image_url: str, claimed_files: dict, ingested: dict) -> dict:
+    """
+    Download one image of an /ingest batch, returning its entry in the batch report.
+
+    `claimed_files` maps the local files of the batch to the url being downloaded
+    to each, `ingested` collects the mapping entries of the images that are ready.
+    """
+    result = {'url': image_url}
+
+    try:
+        parsed_url = parse_obj_as(HttpUrl, image_url)
+    except ValidationError:
+        return {**result, 'status': 'invalid', 'error': 'Not a valid url'}
+
+    if parsed_url.host not in DOWNLOAD_ALLOWED_HOSTS:
+        return {**result, 'status': 'invalid', 'error': f'Image url must be one of the valid foolcdn domains, {DOWNLOAD_ALLOWED_HOSTS}'}
+
+    try:
+        url, filename = get_download_target(parsed_url)
+    except ValueError as e:
+        return {**result, 'status': 'invalid', 'error': str(e)}
+
+    result.update(url=url, path=filename)
+
+    # SQLite may wait for another writer, so the mapping is read off the event loop.
+    if mapped_path := await run_in_threadpool(IMAGE_URL_MAPPING.find_by_url, url):
+        return {**result, 'path': mapped_path, 'status': 'skipped'}
+
+    mapped_url = await run_in_threadpool(IMAGE_URL_MAPPING.get, filename)
+
+    if (owner := mapped_url or claimed_files.setdefault(filename, url)) != url:
+        return {**result, 'status': 'conflict', 'error': f'{filename} is already mapped to {owner}'}
+
+    # Downloads are written atomically, so an unmapped file is a complete download
+    # from a batch that was interrupted before its mapping was saved.
+    if mapped_url is None and os.path.isfile(filename):
+        status = 'resumed'
+    else:
+        try:
+            async with INGEST_LIMIT:
+                await DOWNLOADER.download(url, filename, headers=DOWNLOAD_HEADERS)
+        except DownloadTooLargeError as e:
+            return {**result, 'status': 'too_large', 'error': str(e)}
+        except Exception as e:
+            # Any failure only fails this url, the rest of the batch carries on.
+            logger.warning('Failed to ingest %s: %r', url, e)
+            return {**result, 'status': 'error', 'error': str(e) or repr(e)}
+        status = 'downloaded'
+
+    ingested[filename] = url
+
+    return {**result, 'status': status}
+
+
+@app.post('/ingest')
+async def ingest_images(ingest: IngestRequest, background_tasks: BackgroundTasks):
+    """
+    Download many foolcdn images concurrently and add them to the image mapping.
+
+    Urls already in the mapping are skipped, so a batch that was interrupted
+    can be resubmitted as is. The mapping is written once per batch.
+    """
+    claimed_files, ingested = {}, {}
+    urls = list(dict.fromkeys(ingest.urls))
+
+    try:
+        results = await asyncio.gather(*(ingest_image(url, claimed_files, ingested) for url in urls))
+    finally:
+        # Save whatever finished, even if the batch was cancelled.
+        await run_in_threadpool(IMAGE_URL_MAPPING.set_many, list(ingested.items()))
+
+    if ingest.pregenerate:
+        for result in results:
+            if result['status'] in ['downloaded', 'resumed']:
+                background_tasks.add_task(pregenerate_variants, result['path'])
+
+    summary = {}
+    for result in results:
+        summary[result['status']] = summary.get(result['status'], 0) + 1
+
+    logger.info('Ingested %d urls: %s', len(urls), summary)
+
+    return {'summary': summary, 'results': results}
+
+
 @app.get("/raw/{img_name:path}")
-def serve_original_local_image(img_name: str):
-    if not Path(img_name).exists():
+def serve_original_local_image(img_name: str, request: Request):
+    try:
+        stat = os.stat(img_name)
+    except FileNotFoundError:
         return JSONResponse(status_code=404, content={"error": "Image not found!"})
-    
-    return FileResponse(img_name)
 
+    headers = {
+        'ETag': get_etag(img_name, stat.st_mtime_ns, stat.st_size),
+        'Cache-Control': CACHE_CONTROL
+    }
 
-@app.get("/transform/{img_name:path}")
-def transform_and_serve_image(img_name: str, request: Request, options: ImageOptions = Depends(ImageOptions)):
+    if is_not_modified(request.headers.get('if-none-match'), headers['ETag']):
+        return Response(status_code=304, headers=headers)
 
-    if not Path(img_name).exists():
-        return JSONResponse(status_code=404, content={"error": "Image not found!"})
+    return FileResponse(img_name, headers=headers, stat_result=stat)
 
-    print(f'{img_name = }')
-    print(f'{request.query_params = }')
-    print(f'{request.headers = }')
-    print(f"{request.headers['accept'] = }")
 
-    all_params: dict = get_query_param_dict(str(request.query_params))
-    normalized_query_params: OrderedDict = normalize_query_params(all_params)
-    transform_options_str: str = get_transform_options_str(normalized_query_params)
+@app.get("/transform/{img_name:path}")
+async def transform_and_serve_image(img_name: str, request: Request, options: ImageOptions = Depends(ImageOptions)):
+    start = time.perf_counter()
 
-    print(f'{all_params = }')
-    print(f'{normalized_query_params = }')
-    print(f'{transform_options_str = }')
+    logger.debug('Transform %s, query params %s, headers %s', img_name, request.query_params, request.headers)
 
-    # if valid query params were passed, proceed to process image options
-    print(options)
+    try:
+        stat = os.stat(img_name)
+    except FileNotFoundError:
+        REQUEST_SECONDS.observe('not_found', time.perf_counter() - start)
+        return JSONResponse(status_code=404, content={"error": "Image not found!"})
+
+    all_params: dict = get_query_param_dict(str(request.query_params))
 
     extension = get_extension(
         accept_header=request.headers.get('accept'),
@@ -201,44 +522,191 @@ def transform_and_serve_image(img_name: str, request: Request, options: ImageOpt
         enable_webp=str2bool(all_params.get('enable_webp', 'true'))
     )
 
-    transformed_img_name = get_transformed_image_name(
-        image_filename=img_name,
-        transformed_options=transform_options_str,
-        extension=extension
-    )
+    # Named from the validated options and the original's identity,
+    # so equivalent requests share a variant and originals never collide.
+    transformed_img_name = get_variant_name(img_name, options, extension, stat)
+    logger.debug('Options %s, variant %s', options, transformed_img_name)
+
+    # The ETag only depends on the original and the variant name,
+    # so conditional requests are answered without touching any image.
+    # It's weak, the bytes behind a name can change: the encode profile isn't in the name,
+    # variants may be derived from a cached ancestor and quality=auto may pick another quality.
+    # WebP is negotiated from the Accept header, so caches must vary on it.
+    headers = {
+        'ETag': get_etag(img_name, stat.st_mtime_ns, stat.st_size, transformed_img_name, weak=True),
+        'Cache-Control': CACHE_CONTROL,
+        'Vary': 'Accept'
+    }
+
+    if is_not_modified(request.headers.get('if-none-match'), headers['ETag']):
+        REQUEST_SECONDS.observe('not_modified', time.perf_counter() - start)
+        return Response(status_code=304, headers=headers)
+
+    media_type, _ = mimetypes.guess_type(transformed_img_name)
+
+    # Nothing to transform, serve the original bytes without decoding, encoding or caching a copy.
+    # The transform strips metadata unless `metadata` is set, so only originals without any qualify,
+    # which is checked once per original rather than on every request.
+    if is_passthrough(options, extension, img_name):
+        check_start = time.perf_counter()
+        strip_metadata = not options.metadata and await run_in_threadpool(
+            original_has_metadata, img_name, stat.st_mtime_ns, stat.st_size
+        )
+
+        if not strip_metadata:
+            logger.debug('Passthrough %s', img_name)
+            timings = {'metadata_check': time.perf_counter() - check_start}
+            headers = get_serving_headers(headers, result='passthrough', start=start, timings=timings)
+            return FileResponse(img_name, media_type=media_type, headers=headers, stat_result=stat)
+
+    if (content := VARIANT_CACHE.get(transformed_img_name)) is not None:
+        logger.debug('Memory cache hit %s', transformed_img_name)
+        return serve_variant(content, media_type, headers, result='memory', start=start)
+
+    content = None
+
+    if (output_file := DISK_CACHE.get(transformed_img_name)) is not None:
+        logger.debug('Disk cache hit %s', output_file)
+        read_start = time.perf_counter()
+
+        try:
+            content = await run_in_threadpool(Path(output_file).read_bytes)
+        except FileNotFoundError:
+            # Deleted from disk or evicted since `get`, transform it again.
+            logger.warning('Cached %s is missing', output_file)
+            DISK_CACHE.discard(transformed_img_name, output_file)
+        else:
+            timings = {'disk_read': time.perf_counter() - read_start}
+            result = 'disk'
+
+    if content is None:
+        # Identical concurrent requests share a single transform.
+        try:
+            content, timings = await TRANSFORMS_IN_FLIGHT.do_async(
+                transformed_img_name,
+                transform_image,
+                img_name=img_name,
+                options=options,
+                transformed_img_name=transformed_img_name
+            )
+        except TransformQueueFullError:
+            REQUEST_SECONDS.observe('rejected', time.perf_counter() - start)
+            return JSONResponse(
+                status_code=503,
+                content={"error": "Too many images are being transformed, try again later."},
+                headers={"Retry-After": str(TRANSFORM_RETRY_AFTER_SECONDS)}
+            )
+        result = 'transform'
+
+    VARIANT_CACHE.set(transformed_img_name, content)
+    return serve_variant(content, media_type, headers, result=result, start=start, timings=timings)
+
+
+def get_serving_headers(headers: dict, result: str, start: float, timings: Optional[dict] = None) -> dict:
+    """
+    Add a `Server-Timing` header to the headers of a response,
+    and record the request latency.
+    """
+    total = time.perf_counter() - start
+    REQUEST_SECONDS.observe(result, total)
 
-    output_file = f'{LOCAL_TRANSFORMED_IMG_DIRECTORY}/{transformed_img_name}'
-    print(f'🤞 {output_file = }')
+    server_timing = format_server_timing({**(timings or {}), 'total': total})
+    return {**headers, 'Server-Timing': f'cache;desc="{result}", {server_timing}'}
 
-    if not Path(output_file).exists():
-        img = Image.open(img_name)
-        transformer = ImageTransformer(config=options, img=img, transformed_filename=output_file)
-        buffer = transformer.process_transform_image()
-        transformer.save_buffer_to_file(filename=output_file, buffer=buffer)
-        print('✅', transformed_img_name)
-    else:
-        print('🌟 output file exists!', output_file)
-    return FileResponse(output_file)
+
+def serve_variant(content: bytes, media_type: str, headers: dict, result: str, start: float, timings: Optional[dict] = None) -> Response:
+    """
+    Build the response for a variant with a `Server-Timing` header,
+    and record the request latency.
+    """
+    headers = get_serving_headers(headers, result=result, start=start, timings=timings)
+
+    return Response(content=content, media_type=media_type, headers=headers)
+
+
+@app.get('/metrics')
+def metrics():
+    """
+    Prometheus style metrics for transform latency, caches and the transform engine.
+    """
+    engine_stats = TRANSFORM_ENGINE.stats()
+
+    lines = [
+        *STAGE_SECONDS.render(),
+        *REQUEST_SECONDS.render(),
+        *render_cache_metrics({
+            'memory': VARIANT_CACHE.stats(),
+            'disk': DISK_CACHE.stats(),
+            'decoded_originals': engine_stats['decoded_originals'],
+            'auto_quality': AUTO_QUALITY_CACHE.stats(),
+        }),
+        *render_metric('tmf_transform_queue_pending', 'Transforms running or waiting for a worker.', 'gauge', {None: engine_stats['pending']}),
+        *render_metric('tmf_transform_queue_rejected_total', 'Transforms rejected because the queue was full.', 'counter', {None: engine_stats['rejected']}),
+        *render_metric('tmf_transform_coalesced_total', 'Requests that shared an identical in-flight transform.', 'counter', {None: TRANSFORMS_IN_FLIGHT.coalesced}),
+        *render_metric('tmf_transform_derived_total', 'Variants resampled from a larger cached variant.', 'counter', {None: VARIANT_ANCESTRY.derived}),
+        *render_metric('tmf_downloads_total', 'Originals downloaded.', 'counter', {None: DOWNLOADER.downloaded}),
+        *render_metric('tmf_downloads_rejected_total', 'Downloads rejected for being too large.', 'counter', {None: DOWNLOADER.rejected}),
+    ]
+
+    return PlainTextResponse('\n'.join(lines) + '\n', media_type='text/plain; version=0.0.4')
+
+
+def get_comparison_urls(img_name: str, mapped_img: str, query_string: str) -> dict:
+    """
+    Urls of a local image transformed with the query string and its CloudFlare version.
+    """
+    transform_img_url = f"/transform/{img_name}?{query_string}" if query_string else f"/transform/{img_name}"
+    cloudflare_img_url = f"{mapped_img}?{query_string}" if query_string else mapped_img
+
+    return {
+        "TMF Transformed image url": transform_img_url,
+        "CloudFlare image url": cloudflare_img_url
+    }
 
 
 @app.get('/compare')
-def view_all_comparison_images(request: Request):
-    response = []
+def view_all_comparison_images(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = Query(COMPARE_PAGE_SIZE, ge=1, le=COMPARE_MAX_PAGE_SIZE),
+    prefix: str = ''
+):
+    """
+    Pairs of local images and their CloudFlare versions, sorted by local path,
+    a page at a time. The next page is linked in the `Link` header.
 
-    for img_name, mapped_img in IMAGE_URL_MAPPING.items():
+    `prefix` only lists local paths starting with it. With `Accept: application/x-ndjson`
+    every entry from `cursor` on is streamed as one JSON object per line.
+    Any other query params are passed on to the image urls.
+    """
+    query_string = urlencode([(k, v) for k, v in request.query_params.multi_items() if k not in COMPARE_PARAMS])
 
-        transform_img_url = f"/transform/{img_name}?{str(request.query_params)}" if request.query_params else f"/transform/{img_name}"
-        cloudflare_img_url = f"{mapped_img}?{str(request.query_params)}" if request.query_params else mapped_img
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
 
-        entry = {
-            "TMF Transformed image url": transform_img_url,
-            "CloudFlare image url": cloudflare_img_url,
-            "compare url": f"/compare/{img_name}"
-        }
+    def get_entry(img_name: str, mapped_img: str) -> dict:
+        return {**get_comparison_urls(img_name, mapped_img, query_string), "compare url": f"/compare/{img_name}"}
 
-        response.append(entry)
+    if 'application/x-ndjson' in request.headers.get('accept', ''):
+        # Sent a page at a time
+        chunks = (
+            ''.join(json.dumps(get_entry(img_name, mapped_img)) + '\n' for img_name, mapped_img in entries)
+            for entries in IMAGE_URL_MAPPING.iter_pages(after=after, prefix=prefix)
+        )
+        return StreamingResponse(chunks, media_type='application/x-ndjson')
 
-    return response
+    # One extra entry tells if there is a next page.
+    entries = IMAGE_URL_MAPPING.page(after=after, limit=limit + 1, prefix=prefix)
+    headers = {}
+
+    if len(entries) > limit:
+        entries = entries[:limit]
+        next_params = {**request.query_params, 'cursor': encode_cursor(entries[-1][0])}
+        headers['Link'] = f'<{request.url.path}?{urlencode(next_params)}>; rel="next"'
+
+    return JSONResponse([get_entry(img_name, mapped_img) for img_name, mapped_img in entries], headers=headers)
 
 
 @app.get('/compare/{img_name:path}')
@@ -247,16 +715,9 @@ def compare_images(img_name: str, request: Request):
     if not img_name:
         return JSONResponse(status_code=400, content={"error": "Must include an image path!"})
 
-    print('query params', request.query_params)
+    logger.debug('Compare %s, query params %s', img_name, request.query_params)
 
     if mapped_img := IMAGE_URL_MAPPING.get(img_name):
-
-        transform_img_url = f"/transform/{img_name}?{str(request.query_params)}" if request.query_params else f"/transform/{img_name}"
-        cloudflare_img_url = f"{mapped_img}?{str(request.query_params)}" if request.query_params else mapped_img
-
-        return {
-            "TMF Transformed image url": transform_img_url,
-            "CloudFlare image url": cloudflare_img_url
-        }
+        return get_comparison_urls(img_name, mapped_img, str(request.query_params))
     else:
         return JSONResponse(status_code=404, content={"error": "Image not in mapping!"})
@@ -0,0 +1,164 @@
+from dataclasses import dataclass, field
+import json
+import logging
+import sqlite3
+import threading
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS image_mapping (
+    local_path TEXT PRIMARY KEY,
+    url TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS image_mapping_url ON image_mapping (url);
+CREATE TABLE IF NOT EXISTS imports (
+    source TEXT PRIMARY KEY
+);
+'''
+
+UPSERT = '''
+INSERT INTO image_mapping (local_path, url) VALUES (?, ?)
+ON CONFLICT (local_path) DO UPDATE SET url = excluded.url
+'''
+
+
+@dataclass
+class ImageMapping:
+    """
+    Maps the local path of each original to the url it was downloaded from.
+
+    Stored in SQLite, so lookups by path or url and inserts are indexed, and
+    several processes can share one database. WAL mode lets readers carry on
+    while another process commits, and writers wait up to `busy_timeout`
+    seconds for the write lock.
+
+    The connection is opened lazily, so every process gets its own.
+    """
+    path: str
+    busy_timeout: float = 30.0
+
+    _connection: Optional[sqlite3.Connection] = field(default=None, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+            self._connection = connection
+
+        return self._connection
+
+    def import_json(self, json_file: str) -> int:
+        """
+        Copy the entries of a JSON mapping file into the store, only the first time
+        it is seen. Entries already in the store are kept.
+
+        Returns the number of entries imported.
+        """
+        with self._lock, self.connection as connection:
+            # Take the write lock first so concurrent processes import once.
+            connection.execute('BEGIN IMMEDIATE')
+
+            if connection.execute('SELECT 1 FROM imports WHERE source = ?', (json_file,)).fetchone():
+                return 0
+
+            try:
+                with open(json_file) as f:
+                    entries = json.load(f)
+            except FileNotFoundError:
+                entries = {}
+
+            connection.executemany(
+                'INSERT OR IGNORE INTO image_mapping (local_path, url) VALUES (?, ?)',
+                entries.items()
+            )
+            connection.execute('INSERT INTO imports (source) VALUES (?)', (json_file,))
+
+        logger.info('Imported %d images from %s', len(entries), json_file)
+        return len(entries)
+
+    def get(self, local_path: str) -> Optional[str]:
+        with self._lock:
+            row = self.connection.execute(
+                'SELECT url FROM image_mapping WHERE local_path = ?', (local_path,)
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def find_by_url(self, url: str) -> Optional[str]:
+        """
+        Return the local path an url was downloaded to, if any.
+        """
+        with self._lock:
+            row = self.connection.execute(
+                'SELECT local_path FROM image_mapping WHERE url = ?', (url,)
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def set(self, local_path: str, url: str) -> None:
+        self.set_many([(local_path, url)])
+
+    def set_many(self, entries: Iterable[Tuple[str, str]]) -> None:
+        """
+        Add or update many entries in a single transaction.
+        """
+        with self._lock, self.connection as connection:
+            connection.executemany(UPSERT, entries)
+
+    def items(self) -> List[Tuple[str, str]]:
+        """
+        All (local path, url) entries, oldest first.
+        """
+        with self._lock:
+            return self.connection.execute(
+                'SELECT local_path, url FROM image_mapping ORDER BY rowid'
+            ).fetchall()
+
+    def page(self, after: Optional[str] = None, limit: int = 100, prefix: str = '') -> List[Tuple[str, str]]:
+        """
+        Up to `limit` (local path, url) entries sorted by local path,
+        starting after the local path `after` and only paths starting with `prefix`.
+
+        Pages are read from the primary key index, so their cost doesn't grow
+        with the size of the mapping.
+        """
+        conditions, params = ['local_path > ?'], [after or '']
+
+        if prefix:
+            # Every path starting with `prefix` sorts between it and the prefix with its last character bumped.
+            conditions.append('local_path >= ? AND local_path < ?')
+            params.extend([prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)])
+
+        with self._lock:
+            return self.connection.execute(
+                f'SELECT local_path, url FROM image_mapping WHERE {" AND ".join(conditions)} ORDER BY local_path LIMIT ?',
+                [*params, limit]
+            ).fetchall()
+
+    def iter_pages(self, after: Optional[str] = None, prefix: str = '', page_size: int = 1000) -> Iterator[List[Tuple[str, str]]]:
+        """
+        Every page of entries after `after` starting with `prefix`,
+        so all of them can be walked with flat memory.
+        """
+        while entries := self.page(after=after, limit=page_size, prefix=prefix):
+            yield entries
+            after = entries[-1][0]
+
+    def __contains__(self, local_path: str) -> bool:
+        return self.get(local_path) is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.connection.execute('SELECT COUNT(*) FROM image_mapping').fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
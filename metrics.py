@@ -0,0 +1,93 @@
+from dataclasses import dataclass, field
+import threading
+from typing import List
+
+
+# Seconds, tuned for image transforms that take a few ms up to a few seconds.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+@dataclass
+class Histogram:
+    """
+    Minimal Prometheus style histogram with a single label.
+    """
+    name: str
+    documentation: str
+    label_name: str
+    buckets: tuple = DEFAULT_BUCKETS
+
+    # label value -> bucket counts, last one is +Inf
+    _counts: dict = field(default_factory=dict, repr=False)
+    _sums: dict = field(default_factory=dict, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def observe(self, label_value: str, value: float) -> None:
+        with self._lock:
+            counts = self._counts.setdefault(label_value, [0] * (len(self.buckets) + 1))
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+
+            self._sums[label_value] = self._sums.get(label_value, 0) + value
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+
+        with self._lock:
+            for label_value, counts in sorted(self._counts.items()):
+                label = f'{self.label_name}="{label_value}"'
+
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {count}')
+
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {counts[-1]}')
+                lines.append(f'{self.name}_sum{{{label}}} {self._sums[label_value]}')
+                lines.append(f'{self.name}_count{{{label}}} {counts[-1]}')
+
+        return lines
+
+
+def render_metric(name: str, documentation: str, metric_type: str, samples: dict, label_name: str = None) -> List[str]:
+    """
+    Render a counter or gauge, `samples` maps label values to values
+    (or `None` to a value if the metric has no label).
+    """
+    lines = [f'# HELP {name} {documentation}', f'# TYPE {name} {metric_type}']
+
+    for label_value, value in samples.items():
+        label = f'{{{label_name}="{label_value}"}}' if label_name else ''
+        lines.append(f'{name}{label} {value}')
+
+    return lines
+
+
+def render_cache_metrics(cache_stats: dict) -> List[str]:
+    """
+    Render hit, miss, eviction and size metrics for caches,
+    `cache_stats` maps a cache name to its `stats()` dict.
+    """
+    lines = []
+
+    for stat, metric_type, documentation in [
+        ('hits', 'counter', 'Cache hits.'),
+        ('misses', 'counter', 'Cache misses.'),
+        ('evictions', 'counter', 'Entries evicted from the cache.'),
+        ('bytes', 'gauge', 'Bytes held by the cache.'),
+        ('entries', 'gauge', 'Entries held by the cache.'),
+    ]:
+        samples = {name: stats[stat] for name, stats in cache_stats.items() if stat in stats}
+        suffix = '_total' if metric_type == 'counter' else ''
+        lines.extend(render_metric(f'tmf_cache_{stat}{suffix}', documentation, metric_type, samples, label_name='cache'))
+
+    return lines
+
+
+def format_server_timing(timings: dict) -> str:
+    """
+    Format stage timings in seconds as a `Server-Timing` header,
+    ex. {"decode": 0.0123} -> "decode;dur=12.3"
+    """
+    return ', '.join(f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in timings.items())
@@ -0,0 +1,156 @@
+from collections import OrderedDict
+import hashlib
+import os
+from pathlib import Path
+from urllib.parse import parse_qs
+
+from config import FitEnum, GravityEnum, ImageOptions
+
+
+# Pillow ignores `quality` when saving these formats.
+LOSSLESS_EXTENSIONS = ['.png', '.gif']
+
+
+def str2bool(value) -> bool:
+    """
+    Replacement for `distutils.strtobool` due to
+    its deprecation in Python 3.10.
+    """
+    true_values = ['true', 't', 'yes', 'y', '1']
+    false_values = ['false', 'f', 'no', 'n', '0']
+    value = value.lower()
+    
+    if value in true_values:
+        return True
+    if value in false_values:
+        return False
+
+
+def get_query_param_dict(querystring: str) -> dict:
+    """
+    Convert a query param string into a dictionary.
+    """
+    return {k: v[0] for k, v in parse_qs(querystring.lower()).items()}
+
+
+def get_transform_options_str(normalized_query_params: OrderedDict) -> str:
+    """
+    Flatten query params OrderedDict into string, ex. `height_500_width_500`.
+    """
+    return '_'.join((f'{k}_{v}' for k, v in normalized_query_params.items()))
+
+
+def get_transformed_image_name(image_filename: str, transformed_options: str, extension: str = None) -> str:
+    """
+    Concatenate image name with normalized query parameters
+    to create transformed image filename.
+
+    Ex. "coffee.jpg", "height_1000_width_500" -> "coffee_height_1000_width_500.webp"
+    """
+    if transformed_options:
+        return f'{Path(image_filename).stem}_{transformed_options}{extension}'
+
+    return f'{Path(image_filename).stem}{extension}'
+
+
+def get_canonical_options(options: ImageOptions, extension: str) -> OrderedDict:
+    """
+    Reduce validated image options to only the ones that change the output,
+    with canonical values, sorted by name.
+
+    Ex. "w=500&dpr=2", "width=1000" and "width=1000&quality=80&fit=scale_down"
+    all give OrderedDict([('width', 1000)]).
+    """
+    canonical = {}
+
+    # `dpr` is folded into the dimensions, `w` and `h` are merged into them by the validators.
+    if width := options.prepared_width:
+        canonical['width'] = width
+    if height := options.prepared_height:
+        canonical['height'] = height
+
+    # `fit` only applies with dimensions, the validators unset it otherwise.
+    if options.fit and options.fit is not FitEnum.SCALE_DOWN:
+        canonical['fit'] = options.fit.value
+    if options.fit in [FitEnum.COVER, FitEnum.CROP] and options.gravity is not GravityEnum.CENTER:
+        canonical['gravity'] = options.gravity.value
+
+    if options.background:
+        canonical['background'] = options.background.as_hex().lstrip('#')
+    if options.blur:
+        canonical['blur'] = options.blur
+
+    # 0 and 1 both give the original image.
+    for effect in ['brightness', 'contrast', 'sharpen']:
+        if (value := getattr(options, effect)) not in [None, 0, 1]:
+            canonical[effect] = value
+
+    if rotate := (options.rotate or 0) % 360:
+        canonical['rotate'] = rotate
+    if trim := options.trim:
+        canonical['trim'] = f'{trim.top}-{trim.right}-{trim.bottom}-{trim.left}'
+
+    if options.quality != ImageOptions.__fields__['quality'].default and extension not in LOSSLESS_EXTENSIONS:
+        canonical['quality'] = options.quality
+    if options.quality == 'auto' and extension not in LOSSLESS_EXTENSIONS:
+        for target in ['target_bytes', 'target_ssim']:
+            if (value := getattr(options, target)) is not None:
+                canonical[target] = value
+    if options.metadata:
+        canonical['metadata'] = True
+    if options.anim is False:
+        canonical['anim'] = False
+
+    # `profile` only changes how hard the encoder works, not the image,
+    # so a variant encoded with any profile can be served for the others.
+
+    return OrderedDict(sorted(canonical.items()))
+
+
+def get_original_digest(image_filename: str, stat: os.stat_result) -> str:
+    """
+    Short digest identifying an original by its path, mtime and size,
+    so originals with the same name in different directories don't collide
+    and a replaced original gets new variants.
+    """
+    identity = f'{image_filename}:{stat.st_mtime_ns}:{stat.st_size}'
+    return hashlib.sha1(identity.encode()).hexdigest()[:12]
+
+
+def get_variant_name(image_filename: str, options: ImageOptions, extension: str, stat: os.stat_result) -> str:
+    """
+    Canonical name of a transformed image, used as its cache key.
+
+    Ex. "img/coffee.jpg", width=500 -> "coffee_1a2b3c4d5e6f_width_500.webp"
+    """
+    transform_options_str = get_transform_options_str(get_canonical_options(options, extension))
+    original_digest = get_original_digest(image_filename, stat)
+
+    return get_transformed_image_name(
+        image_filename=image_filename,
+        transformed_options='_'.join(filter(None, [original_digest, transform_options_str])),
+        extension=extension
+    )
+
+
+def is_passthrough(options: ImageOptions, extension: str, image_filename: str) -> bool:
+    """
+    True if no option changes the image and the output format is the original's,
+    so the original file can be served as is.
+
+    Whether metadata may be passed through depends on the file contents,
+    which is left to the caller.
+    """
+    canonical = get_canonical_options(options, extension)
+    canonical.pop('metadata', None)
+
+    return not canonical and extension == Path(image_filename).suffix
+
+
+def get_extension(accept_header: str, image_filename: str, enable_webp: bool = True) -> str:
+    """
+    Returns the extension to use for transformed image.
+    """
+    if accept_header and 'image/webp' in accept_header and enable_webp:
+            return '.webp'
+    return Path(image_filename).suffix
@@ -0,0 +1,86 @@
+"""
+`SingleFlight` shares one call between concurrent callers, a caller that
+goes away must not take the call or the other callers down with it.
+
+Run with `python -m pytest test_cache.py`.
+"""
+import asyncio
+
+import pytest
+
+from cache import SingleFlight
+
+
+async def render(started: asyncio.Event, release: asyncio.Event, calls: list) -> bytes:
+    calls.append(None)
+    started.set()
+    await release.wait()
+    return b'variant'
+
+
+async def start_callers(single_flight: SingleFlight, count: int):
+    started, release, calls = asyncio.Event(), asyncio.Event(), []
+
+    callers = [
+        asyncio.create_task(single_flight.do_async('key', render, started, release, calls))
+        for _ in range(count)
+    ]
+    await started.wait()
+    await asyncio.sleep(0)
+
+    return callers, release, calls
+
+
+def test_cancelled_follower():
+    async def run():
+        single_flight = SingleFlight()
+        (leader, follower, other_follower), release, calls = await start_callers(single_flight, 3)
+
+        follower.cancel()
+        release.set()
+
+        assert await leader == b'variant'
+        assert await other_follower == b'variant'
+        with pytest.raises(asyncio.CancelledError):
+            await follower
+
+        assert len(calls) == 1
+        assert single_flight.coalesced == 2
+
+    asyncio.run(run())
+
+
+def test_cancelled_leader():
+    async def run():
+        single_flight = SingleFlight()
+        (leader, *followers), release, calls = await start_callers(single_flight, 3)
+
+        leader.cancel()
+        release.set()
+
+        assert await asyncio.gather(*followers) == [b'variant', b'variant']
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+
+        assert len(calls) == 1
+
+    asyncio.run(run())
+
+
+def test_finished_call_is_forgotten():
+    async def fail():
+        raise ValueError('broken image')
+
+    async def succeed():
+        return b'variant'
+
+    async def run():
+        single_flight = SingleFlight()
+
+        with pytest.raises(ValueError):
+            await single_flight.do_async('key', fail)
+
+        assert await single_flight.do_async('key', succeed) == b'variant'
+        assert single_flight.coalesced == 0
+
+    asyncio.run(run())
@@ -0,0 +1,124 @@
+"""
+Variants derived from a cached ancestor (see `VariantAncestry`) may only drift
+so far from the same variant resampled from the original.
+
+Run with `python -m pytest test_derivation.py`.
+"""
+import io
+
+from PIL import Image, ImageChops, ImageStat
+import pytest
+
+from cache import CachedVariant, VariantAncestry
+from config import EncodeProfileEnum, ImageOptions
+from engine import render_variant
+
+
+ORIGINALS = [
+    'img/coffee.jpg',
+    'img/puppy.jpg',
+    'img2/woman_with_phone_and_laptop_EF0nQi5.jpg',
+    'img2/women_shopping_in_clothing_store.jpg',
+    'img2/young_family_eating_breakfast.jpg',
+]
+
+# Ancestors `VariantAncestry` accepts by default: lossless, or lossy with quality >= 90.
+ANCESTORS = [
+    ('.png', 80),
+    ('.jpg', 90),
+    ('.webp', 90),
+]
+
+# Mean and largest absolute difference per channel, out of 255.
+# Resampling twice alone drifts up to ~2.3 on average, the lossy ancestors
+# add compression error on top. The largest differences are on sharp edges.
+MAX_MEAN_DRIFT = 4.0
+MAX_PIXEL_DRIFT = 72
+
+# PNG is lossless at any effort, so the comparisons don't need the slow encodes.
+FAST = EncodeProfileEnum.FAST
+
+
+def get_drift(content: bytes, other: bytes) -> tuple:
+    img = Image.open(io.BytesIO(content)).convert('RGB')
+    other_img = Image.open(io.BytesIO(other)).convert('RGB')
+    assert img.size == other_img.size
+
+    diff = ImageChops.difference(img, other_img)
+    mean = sum(ImageStat.Stat(diff).mean) / len(diff.getbands())
+    largest = max(high for _, high in diff.getextrema())
+
+    return mean, largest
+
+
+@pytest.mark.parametrize('extension,quality', ANCESTORS)
+@pytest.mark.parametrize('img_name', ORIGINALS)
+def test_derived_variant_drift(tmp_path, img_name, extension, quality):
+    original_size = Image.open(img_name).size
+
+    # A half size ancestor, the largest pregenerated pyramid level.
+    ancestor_options = ImageOptions(width=original_size[0] // 2, quality=quality)
+    ancestor, _, _ = render_variant(img_name, ancestor_options, f'ancestor{extension}', encode_profile=FAST)
+    ancestor_file = tmp_path / f'ancestor{extension}'
+    ancestor_file.write_bytes(ancestor)
+
+    assert VariantAncestry().is_high_quality(CachedVariant(
+        key=ancestor_file.name,
+        size=Image.open(ancestor_file).size,
+        original_size=original_size,
+        quality=quality,
+        extension=extension
+    ))
+
+    # Compared losslessly, so the drift isn't hidden by the output's own compression.
+    for width in [original_size[0] // 4, 150]:
+        options = ImageOptions(width=width)
+        expected, _, _ = render_variant(img_name, options, 'variant.png', encode_profile=FAST)
+        derived, _, _ = render_variant(
+            str(ancestor_file), options, 'variant.png', original_size=original_size, encode_profile=FAST
+        )
+
+        mean, largest = get_drift(expected, derived)
+
+        assert mean <= MAX_MEAN_DRIFT, f'{img_name} width={width} drifted {mean:.2f} on average'
+        assert largest <= MAX_PIXEL_DRIFT, f'{img_name} width={width} drifted {largest} at most'
+
+
+def test_default_quality_variants_are_not_ancestors():
+    variant = CachedVariant(
+        key='puppy_width_1000.jpg',
+        size=(1000, 667),
+        original_size=(1920, 1280),
+        quality=ImageOptions().quality,
+        extension='.jpg'
+    )
+
+    assert not VariantAncestry().is_high_quality(variant)
+
+
+def test_derived_variants_are_not_ancestors():
+    """
+    A chain of derivations would add a resample and an encode per hop,
+    which the drift bounds above don't cover.
+    """
+    ancestry = VariantAncestry()
+    original_size = (4480, 6720)
+
+    def add(width: int, generation: int) -> None:
+        ancestry.add('coffee.jpg', CachedVariant(
+            key=f'coffee_width_{width}.webp',
+            size=(width, width * 3 // 2),
+            original_size=original_size,
+            quality=95,
+            extension='.webp',
+            generation=generation
+        ))
+
+    # width=2000 rendered from the original, then 900 and 300 derived from it.
+    add(2000, generation=0)
+    add(900, generation=1)
+    add(300, generation=1)
+
+    ancestor = ancestry.find('coffee.jpg', width=100, height=None, is_available=lambda key: True)
+
+    assert ancestor.key == 'coffee_width_2000.webp'
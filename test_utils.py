@@ -0,0 +1,62 @@
+"""
+`has_metadata` decides whether an original may be served as is by `/transform`,
+so it must find every kind of metadata the transform strips.
+
+Run with `python -m pytest test_utils.py`.
+"""
+import io
+import zlib
+
+from PIL import Image, PngImagePlugin
+import pytest
+
+from utils import has_metadata
+
+
+def encode(extension: str, **save_options) -> bytes:
+    img = Image.new('RGB', (64, 48), 'teal')
+    buffer = io.BytesIO()
+    img.save(buffer, format=Image.registered_extensions()[extension], **save_options)
+    return buffer.getvalue()
+
+
+def png_with_text() -> bytes:
+    info = PngImagePlugin.PngInfo()
+    info.add_text('Author', 'Jane Doe')
+    info.add_text('GPS', '51.5, -0.12', zip=True)
+    return encode('.png', pnginfo=info)
+
+
+def jpeg_with_iptc() -> bytes:
+    payload = b'Photoshop 3.0\x008BIM\x04\x04\x00\x00\x00\x00\x00\x08Jane Doe'
+    app13 = b'\xff\xed' + (len(payload) + 2).to_bytes(2, 'big') + payload
+    content = encode('.jpg')
+    return content[:2] + app13 + content[2:]
+
+
+@pytest.mark.parametrize('content', [
+    png_with_text(),
+    encode('.png', exif=b'Exif\x00\x00MM\x00\x2a\x00\x00\x00\x08\x00\x00'),
+    jpeg_with_iptc(),
+    encode('.jpg', comment=b'Jane Doe'),
+    encode('.jpg', exif=b'Exif\x00\x00MM\x00\x2a\x00\x00\x00\x08\x00\x00'),
+    encode('.webp', xmp=b'<x:xmpmeta/>'),
+    encode('.gif', comment=b'Jane Doe'),
+], ids=['png text', 'png exif', 'jpeg iptc', 'jpeg comment', 'jpeg exif', 'webp xmp', 'gif comment'])
+def test_has_metadata(content):
+    assert has_metadata(content)
+
+
+@pytest.mark.parametrize('extension', ['.png', '.jpg', '.webp', '.gif'])
+def test_no_metadata(extension):
+    assert not has_metadata(encode(extension))
+
+
+def test_markers_inside_chunks_are_not_metadata():
+    # A private chunk whose data spells out metadata markers, as pixel data can by chance.
+    data = b'EXIF' + b'XMP ' + b'tEXt' + b'eXIf'
+    chunk = len(data).to_bytes(4, 'big') + b'prVt' + data + zlib.crc32(b'prVt' + data).to_bytes(4, 'big')
+    content = encode('.png')
+    iend = content.index(b'IEND') - 4
+
+    assert not has_metadata(content[:iend] + chunk + content[iend:])
@@ -1,15 +1,21 @@
+import base64
+import binascii
+from contextlib import contextmanager
 from dataclasses import dataclass
 from decimal import Decimal, ROUND_HALF_UP
 from enum import Enum
+import hashlib
 import io
 import logging
+import os
 import re
+import tempfile
 from typing import Union, Optional, Literal
 from pathlib import Path
 
 # from pydantic import BaseModel
 # from pydantic.color import Color
-from PIL import Image, ImageColor, ImageOps, ImageFilter, ImageEnhance
+from PIL import Image, ImageColor, ImageOps, ImageFilter, ImageEnhance, ImageMath
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +34,215 @@ def get_filename_extension(name: str) -> str:
     return Path(name).suffix
 
 
+def get_etag(*parts, weak: bool = False) -> str:
+    """
+    Build an ETag from the parts that identify a response,
+    ex. an original's path, mtime and size plus the variant name.
+
+    Strong ETags promise byte identical responses, so responses whose bytes
+    can change for the same parts must use a weak one.
+    """
+    digest = hashlib.sha1(':'.join(str(part) for part in parts).encode()).hexdigest()
+    return f'W/"{digest}"' if weak else f'"{digest}"'
+
+
+def is_not_modified(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Check an `If-None-Match` header against an ETag,
+    using weak comparison as required for `If-None-Match`.
+    """
+    if not if_none_match:
+        return False
+
+    if if_none_match.strip() == '*':
+        return True
+
+    def opaque_tag(tag: str) -> str:
+        return tag[2:] if tag.startswith('W/') else tag
+
+    tags = (tag.strip() for tag in if_none_match.split(','))
+    return opaque_tag(etag) in (opaque_tag(tag) for tag in tags)
+
+
+# Metadata the transform strips unless `metadata` is set, found by walking the
+# chunks or segments of a file, so pixel data that happens to contain a marker doesn't count.
+# A false match only means the image is transformed instead of passed through.
+PNG_METADATA_CHUNKS = (b'eXIf', b'tEXt', b'zTXt', b'iTXt', b'tIME')
+WEBP_METADATA_CHUNKS = (b'EXIF', b'XMP ')
+GIF_XMP_APPLICATION = b'XMP DataXMP'
+# Every JPEG APPn segment is metadata (EXIF and XMP in APP1, IPTC in APP13, ...)
+# except JFIF (APP0), ICC profiles (APP2) and Adobe's color transform (APP14), and so is COM.
+JPEG_IMAGE_APP_MARKERS = (0xE0, 0xE2, 0xEE)
+JPEG_COM_MARKER = 0xFE
+JPEG_SOS_MARKER = 0xDA
+JPEG_EOI_MARKER = 0xD9
+# Inside entropy coded data 0xFF is only followed by a stuffed 0x00 or a restart marker.
+JPEG_NEXT_MARKER = re.compile(rb'\xff(?=[^\x00\xd0-\xd7\xff])')
+
+
+def _has_png_metadata(content: bytes) -> bool:
+    position = 8
+
+    while position + 8 <= len(content):
+        length = int.from_bytes(content[position:position + 4], 'big')
+        chunk_type = content[position + 4:position + 8]
+
+        if chunk_type in PNG_METADATA_CHUNKS:
+            return True
+        if chunk_type == b'IEND':
+            return False
+
+        position += 12 + length  # length, type, data and crc
+
+    return True
+
+
+def _has_jpeg_metadata(content: bytes) -> bool:
+    position = 2
+
+    while position + 2 <= len(content):
+        if content[position] != 0xFF:
+            return True
+
+        marker = content[position + 1]
+
+        if marker == 0xFF:  # fill byte
+            position += 1
+            continue
+        if marker == JPEG_EOI_MARKER:
+            return False
+        if 0xD0 <= marker <= 0xD7:  # restart markers have no length
+            position += 2
+            continue
+        if marker == JPEG_COM_MARKER or (0xE0 <= marker <= 0xEF and marker not in JPEG_IMAGE_APP_MARKERS):
+            return True
+
+        position += 2 + int.from_bytes(content[position + 2:position + 4], 'big')
+
+        if marker == JPEG_SOS_MARKER:
+            # Progressive JPEGs have more segments between their scans.
+            if not (match := JPEG_NEXT_MARKER.search(content, position)):
+                return True
+            position = match.start()
+
+    return True
+
+
+def _has_webp_metadata(content: bytes) -> bool:
+    position = 12
+
+    while position + 8 <= len(content):
+        chunk_type = content[position:position + 4]
+        length = int.from_bytes(content[position + 4:position + 8], 'little')
+
+        if chunk_type in WEBP_METADATA_CHUNKS:
+            return True
+
+        position += 8 + length + length % 2  # chunks are padded to an even size
+
+    return False
+
+
+def _has_gif_metadata(content: bytes) -> bool:
+    def color_table_size(flags: int) -> int:
+        return 3 << ((flags & 0x07) + 1) if flags & 0x80 else 0
+
+    position = 13 + color_table_size(content[10])
+
+    while position < len(content):
+        block = content[position]
+
+        if block == 0x3B:  # trailer
+            return False
+
+        if block == 0x21:  # extension
+            label = content[position + 1]
+            position += 2
+
+            if label == 0xFE:  # comment
+                return True
+            if label == 0xFF and content[position + 1:position + 12] == GIF_XMP_APPLICATION:
+                return True
+        elif block == 0x2C:  # image descriptor, then the LZW minimum code size
+            position += 11 + color_table_size(content[position + 9])
+        else:
+            return True
+
+        # Skip the data sub-blocks, up to the empty one that ends them.
+        while position < len(content) and (size := content[position]):
+            position += size + 1
+        position += 1
+
+    return True
+
+
+def has_metadata(content: bytes) -> bool:
+    """
+    Check an encoded image for metadata the transform strips, without decoding it:
+    EXIF, XMP, IPTC, comments and PNG text chunks.
+
+    Only PNG, JPEG, WebP and GIF files are read, other formats and
+    malformed files are assumed to have metadata.
+    """
+    try:
+        if content.startswith(b'\x89PNG\r\n\x1a\n'):
+            return _has_png_metadata(content)
+        if content.startswith(b'\xff\xd8'):
+            return _has_jpeg_metadata(content)
+        if content.startswith(b'RIFF') and content[8:12] == b'WEBP':
+            return _has_webp_metadata(content)
+        if content.startswith((b'GIF87a', b'GIF89a')):
+            return _has_gif_metadata(content)
+    except IndexError:
+        return True
+
+    return True
+
+
+def encode_cursor(value: str) -> str:
+    """
+    Opaque, url safe pagination cursor for a value.
+    """
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> str:
+    """
+    Value of a cursor from `encode_cursor`, raises `ValueError` if it is malformed.
+    """
+    try:
+        return base64.b64decode(cursor + '=' * (-len(cursor) % 4), altchars=b'-_', validate=True).decode()
+    except (binascii.Error, UnicodeDecodeError) as e:
+        raise ValueError(f'Invalid cursor {cursor!r}') from e
+
+
+@contextmanager
+def atomic_file(filename: str):
+    """
+    Open a temp file next to `filename` for writing and rename it into place
+    when the block exits, so readers never see a partially written file.
+    The temp file is removed if the block raises.
+    """
+    directory = os.path.dirname(filename) or '.'
+    fd, temp_filename = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            yield temp_file
+        os.replace(temp_filename, filename)
+    except BaseException:
+        os.unlink(temp_filename)
+        raise
+
+
+def write_file_atomic(filename: str, data) -> None:
+    """
+    Write bytes to a temp file next to `filename` and rename it into place.
+    """
+    with atomic_file(filename) as f:
+        f.write(data)
+
+
 # def get_new_dimensions(img: Image, width: int = None, height: int = None) -> tuple:
 #     """
 #     Return new dimensions given original image's aspect ratio and a width or height.
@@ -403,6 +618,42 @@ def contrast(img: Image, contrast_amount: Union[float, int]) -> Image:
     return filter.enhance(contrast_amount)
 
 
+# SSIM stabilizing constants for 8 bit pixel values.
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+
+def get_ssim(reference: Image, distorted: Image, block_size: int = 8) -> float:
+    """
+    Structural similarity of two images of the same size, from 0 to 1 (identical).
+
+    Computed on luminance over `block_size` pixel blocks and averaged,
+    using Pillow's float images so it stays cheap at full resolution.
+    Block means come from box resizing instead of a sliding window.
+    """
+    x = reference.convert('L').convert('F')
+    y = distorted.convert('L').convert('F')
+
+    blocks = (max(x.width // block_size, 1), max(x.height // block_size, 1))
+
+    def mean(img: Image) -> Image:
+        return img.resize(blocks, Image.Resampling.BOX)
+
+    ssim_map = ImageMath.eval(
+        '((2 * mx * my + c1) * (2 * (mxy - mx * my) + c2))'
+        ' / ((mx * mx + my * my + c1) * (mxx - mx * mx + myy - my * my + c2))',
+        mx=mean(x),
+        my=mean(y),
+        mxx=mean(ImageMath.eval('x * x', x=x)),
+        myy=mean(ImageMath.eval('y * y', y=y)),
+        mxy=mean(ImageMath.eval('x * y', x=x, y=y)),
+        c1=SSIM_C1,
+        c2=SSIM_C2
+    )
+
+    return ssim_map.resize((1, 1), Image.Resampling.BOX).getpixel((0, 0))
+
+
 def read_from_bytes(img_bytes_str: bytes) -> Image:
     """
     Return a Pillow Image from bytes string.